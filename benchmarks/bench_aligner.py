@@ -0,0 +1,131 @@
+"""Microbenchmark for the aligner's margin and band detection.
+
+Times the vectorized find_content_margins / detect_horizontal_bands against
+the original column-by-column and row-by-row scans and checks that both give
+identical results on every page.
+
+    python benchmarks/bench_aligner.py [png_dir] [--repeat N]
+
+png_dir defaults to the cropper output directory; a synthetic grid page is
+used when it holds no PNGs.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import align_questionnaire as aligner
+from page_image import to_gray
+
+def loop_content_margins(image, threshold=30):
+    """The original column-by-column margin scan, kept as the reference."""
+    gray = to_gray(image)
+    height, width = gray.shape
+
+    def compute_gradient(column):
+        return np.abs(np.diff(column.astype(np.float32)))
+
+    left_margin = 0
+    right_margin = width - 1
+
+    for x in range(width // 2):
+        left_gradient = compute_gradient(gray[:, x])
+        right_gradient = compute_gradient(gray[:, width - 1 - x])
+
+        if left_margin == 0 and np.max(left_gradient) > threshold:
+            left_margin = x
+
+        if right_margin == width - 1 and np.max(right_gradient) > threshold:
+            right_margin = width - 1 - x
+
+        if left_margin != 0 and right_margin != width - 1:
+            break
+
+    return left_margin-10, right_margin+10
+
+def loop_horizontal_bands(image, left_margin, right_margin):
+    """The original row-by-row band scan, kept as the reference."""
+    gray = to_gray(image)
+    height, width = gray.shape
+    edge_sum = np.sum(cv2.Canny(gray[:, left_margin:right_margin], 50, 150), axis=1)
+
+    threshold = aligner.config.getint('aligner', 'horizontal_band_threshold')
+    min_gap = aligner.config.getint('aligner', 'min_band_gap')
+
+    bands = [0]
+    last_band = 0
+    for y in range(1, height - 1):
+        if edge_sum[y] > threshold * (right_margin - left_margin) and y - last_band >= min_gap:
+            bands.append(y)
+            last_band = y
+
+    if bands[-1] != height - 1:
+        bands.append(height - 1)
+
+    return bands
+
+def synthetic_page(width=600, height=800):
+    page = np.full((height, width), 255, np.uint8)
+    cv2.rectangle(page, (60, 40), (width - 60, height - 40), 0, 2)
+    for y in range(80, height - 40, 55):
+        cv2.line(page, (60, y), (width - 60, y), 0, 2)
+    return page
+
+def load_pages(png_dir):
+    if png_dir and os.path.isdir(png_dir):
+        names = sorted(f for f in os.listdir(png_dir) if f.endswith('.png'))
+        pages = [cv2.imread(os.path.join(png_dir, name), cv2.IMREAD_GRAYSCALE) for name in names]
+        pages = [page for page in pages if page is not None]
+        if pages:
+            return pages
+    print("No PNG pages found, using a synthetic page.")
+    return [synthetic_page()]
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('png_dir', nargs='?', default=os.path.join(aligner.project_root, aligner.config.get('aligner', 'input_dir')))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pages = load_pages(args.png_dir)
+    totals = {'margins_loop': 0.0, 'margins_vectorized': 0.0, 'bands_loop': 0.0, 'bands_vectorized': 0.0}
+    mismatches = 0
+
+    for page in pages:
+        elapsed, reference_margins = best_time(lambda: loop_content_margins(page), args.repeat)
+        totals['margins_loop'] += elapsed
+        elapsed, margins = best_time(lambda: aligner.find_content_margins(page), args.repeat)
+        totals['margins_vectorized'] += elapsed
+
+        left_margin, right_margin = margins
+        elapsed, reference_bands = best_time(lambda: loop_horizontal_bands(page, left_margin, right_margin), args.repeat)
+        totals['bands_loop'] += elapsed
+        elapsed, bands = best_time(lambda: aligner.detect_horizontal_bands(page, left_margin, right_margin), args.repeat)
+        totals['bands_vectorized'] += elapsed
+
+        if margins != reference_margins or bands != reference_bands:
+            mismatches += 1
+
+    count = len(pages)
+    for step in ('margins', 'bands'):
+        loop_ms = totals[f'{step}_loop'] / count * 1000
+        vectorized_ms = totals[f'{step}_vectorized'] / count * 1000
+        print(f"{step:8s} loop {loop_ms:8.3f} ms/page  vectorized {vectorized_ms:8.3f} ms/page  speedup {loop_ms / vectorized_ms:6.1f}x")
+    print(f"{count} pages, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
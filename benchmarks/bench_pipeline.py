@@ -0,0 +1,255 @@
+"""Per-stage and end-to-end benchmark on synthetic questionnaires.
+
+Generates a seeded batch with benchmarks/synthetic_survey.py, runs every
+stage over the whole batch in turn and reports pages/sec, how far the RSS
+rose above its level at the start of the stage and, where it applies,
+accuracy against the known answers (deskew angle error and grading
+accuracy). Runs fully offline; PDF rendering is only timed when
+poppler is installed, otherwise pages are handed over in memory.
+
+    python benchmarks/bench_pipeline.py [--pdfs 4] [--pages 5] [--dpi 200] [--skew 2] [--noise 3]
+                                        [--json out.json] [--baseline previous.json]
+
+With --baseline, the run fails if a stage got more than --max-slowdown
+slower or grading accuracy fell below --min-accuracy. It also fails if
+grading pages as a batch gives any page a different result from grading it
+alone, checked on the batch and on a noise-free copy whose solid marks tie.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import synthetic_survey
+import cropper
+import align_questionnaire as aligner
+import vertical_scan_ocr as ocr
+import pipeline
+import debug_writer
+from page_cache import PageCache
+
+class RssSampler:
+    """Samples the process RSS on a background thread and keeps the peak, and the RSS it started from."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start = self.peak = 0
+        self.stopped = threading.Event()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+def run_stage(results, name, func, items, count):
+    """Apply func to every item, recording time and peak RSS; returns the outputs.
+
+    The RSS is reported as its rise above the level the stage started at, so
+    the outputs earlier stages still hold do not count towards the stage.
+    """
+    with RssSampler() as sampler, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        outputs = [func(item) for item in items]
+        elapsed = time.perf_counter() - start
+    results[name] = {
+        'seconds': elapsed,
+        'pages_per_sec': count / elapsed if elapsed else float('inf'),
+        'rss_rise_mb': (sampler.peak - sampler.start) / 2**20
+    }
+    return outputs
+
+def grade_accuracy(grades_per_page, answers_per_page):
+    correct = total = 0
+    for grades, answers in zip(grades_per_page, answers_per_page):
+        detected = [grade for _, _, grade in grades or []]
+        correct += sum(1 for i, answer in enumerate(answers) if i < len(detected) and detected[i] == answer)
+        total += len(answers)
+    return correct / total if total else 0.0
+
+def batch_mismatches(pages, bands, size):
+    """Indices of pages that grade_batch grades differently from grade_image, in either ink representation."""
+    mismatched = set()
+    configured = ocr.ink_representation
+    try:
+        for representation in ('gray', 'packed'):
+            ocr.ink_representation = representation
+            for start in range(0, len(pages), size):
+                chunk = pages[start:start + size]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    alone = [ocr.grade_image(image, bands, 'page.png') for image in chunk]
+                stack = np.stack([ocr.ink_page(image) for image in chunk])
+                cells, percentages, grades = ocr.grade_batch(stack, bands, ocr.packed_width(chunk[0].shape[1]))
+                for k, (ink_cells, page_grades) in enumerate(alone):
+                    if (ink_cells or [], page_grades or []) != ocr.page_grades(cells[k], percentages[k], grades[k]):
+                        mismatched.add(start + k)
+    finally:
+        ocr.ink_representation = configured
+    return mismatched
+
+def render_pages(batch, args, workdir):
+    """Rendered PIL pages for the batch, through poppler when available."""
+    if shutil.which('pdftoppm') and not args.in_memory:
+        synthetic_survey.write_batch(workdir, args.pdfs, args.pages, args.dpi, args.skew, args.noise, args.seed)
+        pdf_paths = [os.path.join(workdir, f) for f in cropper.list_pdf_files(workdir)]
+        return 'render', lambda path: [page for _, page in cropper.iter_pdf_pages(path, cropper.render_window)], pdf_paths
+    pages = [page for _, _, page, _, _ in batch]
+    return 'render (in memory)', lambda page: [Image.fromarray(synthetic_survey.to_render_dpi(page, args.dpi))], pages
+
+def run_benchmark(args):
+    batch = list(synthetic_survey.iter_survey_pages(args.pdfs, args.pages, args.dpi, args.skew, args.noise, args.seed))
+    answers = [page_answers for _, _, _, page_answers, _ in batch]
+    skews = [skew for _, _, _, _, skew in batch]
+    count = len(batch)
+    results = {}
+
+    # The end-to-end run must measure real work, not cache hits or debug encoding
+    pipeline.page_cache = PageCache(None, 0, enabled=False)
+    debug_writer.writers[os.getpid()] = debug_writer.DebugWriter(level='off')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        render_name, render, sources = render_pages(batch, args, workdir)
+        rendered = [page for pages in run_stage(results, render_name, render, sources, count) for page in pages]
+
+    cropped = run_stage(results, 'crop', lambda page: cropper.crop_page(page, cropper.rect_width, cropper.rect_height)[0],
+                        rendered, count)
+
+    # Deskew, margins and bands run on the analysis level ([aligner] analysis_dpi), as align_image does
+    deskewed = run_stage(results, 'deskew', aligner.deskew_image, cropped, count)
+    # The page was rotated by +skew, so the correcting angle is -skew
+    angle_errors = [abs(angle + skew) for (angle, _, _, _), skew in zip(deskewed, skews)]
+    results['deskew']['mean_angle_error'] = sum(angle_errors) / count
+    rotated = [image for _, image, _, _ in deskewed]
+
+    margins = run_stage(results, 'margins', lambda item: aligner.level_margins(item[2], item[3]), deskewed, count)
+    horizontal = run_stage(results, 'bands', lambda item: aligner.level_bands(item[0][1], item[0][2], item[0][3], *item[1]),
+                           list(zip(deskewed, margins)), count)
+    vertical = [aligner.create_grade_bands(left, right, ocr.number_of_grades) for left, right in margins]
+
+    candidates = run_stage(results, 'ink scan', lambda item: ocr.scan_ink_cells(ocr.ink_page(item[0]), item[1], ocr.packed_width(item[0].shape[1])),
+                           list(zip(rotated, horizontal)), count)
+    cells = run_stage(results, 'nms', lambda item: ocr.non_max_suppression(item, ocr.overlap_threshold, max_detections=ocr.number_of_questions),
+                      candidates, count)
+    grades = run_stage(results, 'grading', lambda item: ocr.calculate_grades(ocr.filter_horizontal_cells(item[0]), 0, item[1]),
+                       list(zip(cells, vertical)), count)
+    results['grading']['accuracy'] = grade_accuracy(grades, answers)
+
+    def end_to_end(page):
+        cropped_page, _ = cropper.crop_page(page, cropper.rect_width, cropper.rect_height)
+        return pipeline.process_page(cropped_page, 'page.png')['grades']
+
+    end_to_end_grades = run_stage(results, 'end to end', end_to_end, rendered, count)
+    results['end to end']['accuracy'] = grade_accuracy(end_to_end_grades, answers)
+
+    # Template mode: bands detected once on the first page, every page registered to them
+    with contextlib.redirect_stdout(io.StringIO()):
+        template = aligner.build_template(cropped[0])
+    registered = run_stage(results, 'register', lambda image: aligner.register_image(image, template)[0], cropped, count)
+    template_bands = aligner.band_entry(template.layout)
+    with contextlib.redirect_stdout(io.StringIO()):
+        template_grades = [ocr.grade_image(image, template_bands, 'page.png')[1] for image in registered]
+    results['register']['accuracy'] = grade_accuracy(template_grades, answers)
+
+    # The registered pages graded grade_batch_size at a time, as stacked arrays
+    size = max(args.grade_batch, 1)
+    stacks = [np.stack([ocr.ink_page(image) for image in registered[i:i + size]])
+              for i in range(0, count, size)]
+    matrices = run_stage(results, 'grade batch', lambda pages: ocr.grade_batch(pages, template_bands, ocr.packed_width(registered[0].shape[1])), stacks, count)
+    batch_grades = [ocr.page_grades(cells[k], percentages[k], grades[k])[1]
+                    for cells, percentages, grades in matrices for k in range(len(cells))]
+    results['grade batch']['accuracy'] = grade_accuracy(batch_grades, answers)
+
+    # Batched grading must match page-by-page grading, including exact score ties on solid marks
+    solid = [Image.fromarray(synthetic_survey.to_render_dpi(page, args.dpi))
+             for _, _, page, _, _ in synthetic_survey.iter_survey_pages(args.pdfs, args.pages, args.dpi, args.skew, 0, args.seed)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        solid = [aligner.register_image(cropper.crop_page(page, cropper.rect_width, cropper.rect_height)[0], template)[0]
+                 for page in solid]
+    results['grade batch']['mismatched_pages'] = (len(batch_mismatches(registered, template_bands, size))
+                                                  + len(batch_mismatches(solid, template_bands, size)))
+    return results
+
+def print_results(results):
+    print(f"{'stage':20s} {'pages/s':>10s} {'ms/page':>9s} {'RSS rise MB':>12s}  accuracy")
+    for name, stage in results.items():
+        count = stage['pages_per_sec'] * stage['seconds']
+        accuracy = ''
+        if 'accuracy' in stage:
+            accuracy = f"{stage['accuracy']:.1%}"
+            if 'mismatched_pages' in stage:
+                accuracy += f", {stage['mismatched_pages']} pages differ from page-by-page"
+        elif 'mean_angle_error' in stage:
+            accuracy = f"mean angle error {stage['mean_angle_error']:.2f} deg"
+        print(f"{name:20s} {stage['pages_per_sec']:10.1f} {stage['seconds'] / count * 1000:9.2f} "
+              f"{stage['rss_rise_mb']:12.1f}  {accuracy}")
+
+def regressions(results, baseline, max_slowdown, min_accuracy):
+    problems = []
+    for name, stage in results.items():
+        if 'accuracy' in stage and stage['accuracy'] < min_accuracy:
+            problems.append(f"{name}: accuracy {stage['accuracy']:.1%} below {min_accuracy:.1%}")
+        if stage.get('mismatched_pages'):
+            problems.append(f"{name}: {stage['mismatched_pages']} pages graded differently than one at a time")
+        if baseline and name in baseline:
+            floor = baseline[name]['pages_per_sec'] * (1 - max_slowdown)
+            if stage['pages_per_sec'] < floor:
+                problems.append(f"{name}: {stage['pages_per_sec']:.1f} pages/s, baseline {baseline[name]['pages_per_sec']:.1f}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pdfs', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--dpi', type=int, default=synthetic_survey.RENDER_DPI)
+    parser.add_argument('--skew', type=float, default=2.0)
+    parser.add_argument('--noise', type=float, default=3.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--grade-batch', type=int, default=32, help="pages per stack in the 'grade batch' stage")
+    parser.add_argument('--in-memory', action='store_true', help="skip PDF rendering even if poppler is installed")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file of a previous run to compare against")
+    parser.add_argument('--max-slowdown', type=float, default=0.2)
+    parser.add_argument('--min-accuracy', type=float, default=0.95)
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    problems = regressions(results, baseline, args.max_slowdown, args.min_accuracy)
+    for problem in problems:
+        print(f"Regression: {problem}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
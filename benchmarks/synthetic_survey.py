@@ -0,0 +1,139 @@
+"""Synthetic questionnaire generator.
+
+Renders survey pages laid out like config/questions.json: question text on
+the left and a grade grid (one column per grade, one row per question) on
+the right edge, where the cropper looks for it. Each question gets one
+filled mark in a known grade column, so pipeline output can be scored.
+Skew, noise, DPI and page counts are controllable and everything is seeded.
+
+    python benchmarks/synthetic_survey.py out_dir [--pdfs 4] [--pages 2] [--dpi 200] [--skew 2] [--noise 3] [--seed 0]
+
+writes out_dir/survey_XXX.pdf plus out_dir/ground_truth.json.
+"""
+import argparse
+import json
+import os
+import sys
+import unicodedata
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import vertical_scan_ocr as ocr
+
+# A4 portrait, in inches
+PAGE_WIDTH = 8.27
+PAGE_HEIGHT = 11.69
+# Grade grid geometry, in inches
+GRID_RIGHT_MARGIN = 0.35
+GRID_WIDTH = 2.4
+ROW_HEIGHT = 0.22
+HEADER_HEIGHT = 0.25
+MARK_RADIUS = 0.05
+# Resolution pdf2image renders at by default
+RENDER_DPI = 200
+
+def ascii_text(text):
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+
+def random_answers(rng, number_of_questions=ocr.number_of_questions, number_of_grades=ocr.number_of_grades):
+    return rng.integers(1, number_of_grades + 1, number_of_questions).tolist()
+
+def render_page(answers, dpi=RENDER_DPI, skew=0.0, noise=3.0, rng=None):
+    """Render one page as a grayscale array; answers[i] is the 1-based grade of question i."""
+    rng = rng if rng is not None else np.random.default_rng()
+    px = lambda inches: int(round(inches * dpi))
+    width, height = px(PAGE_WIDTH), px(PAGE_HEIGHT)
+    page = np.full((height, width), 255, np.uint8)
+    line = max(px(0.01), 1)
+
+    number_of_grades = ocr.number_of_grades
+    right = width - px(GRID_RIGHT_MARGIN)
+    left = right - px(GRID_WIDTH)
+    column_width = (right - left) / number_of_grades
+    grid_height = px(HEADER_HEIGHT) + len(answers) * px(ROW_HEIGHT)
+    top = (height - grid_height) // 2
+    bottom = top + grid_height
+
+    # Header with the grade numbers, then one ruled row per question
+    for g in range(number_of_grades):
+        cv2.putText(page, str(g + 1), (int(left + (g + 0.4) * column_width), top + px(HEADER_HEIGHT) - px(0.06)),
+                    cv2.FONT_HERSHEY_SIMPLEX, dpi / 400, 0, line)
+    for k in range(number_of_grades + 1):
+        x = int(round(left + k * column_width))
+        cv2.line(page, (x, top), (x, bottom), 0, line)
+    row_tops = [top + px(HEADER_HEIGHT) + i * px(ROW_HEIGHT) for i in range(len(answers))]
+    for y in [top] + row_tops + [bottom]:
+        cv2.line(page, (left, y), (right, y), 0, line)
+
+    # Question text well left of the cropped strip, and one mark per row
+    text_scale = dpi / 500
+    for (section, question), y, grade in zip(ocr.question_list, row_tops, answers):
+        cv2.putText(page, ascii_text(question)[:60], (px(0.6), y + px(0.14)), cv2.FONT_HERSHEY_SIMPLEX, text_scale, 0, line)
+        jitter = rng.uniform(-0.2, 0.2) * column_width
+        center = (int(left + (grade - 0.5) * column_width + jitter), y + px(0.065))
+        cv2.circle(page, center, px(MARK_RADIUS), 0, -1)
+
+    if skew:
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        page = cv2.warpAffine(page, rotation, (width, height), flags=cv2.INTER_LINEAR, borderValue=255)
+    if noise:
+        page = np.clip(page + rng.normal(0, noise, page.shape), 0, 255).astype(np.uint8)
+    return page
+
+def to_render_dpi(page, dpi):
+    """Resample a page generated at dpi to what pdf2image would render (RENDER_DPI)."""
+    if dpi == RENDER_DPI:
+        return page
+    scale = RENDER_DPI / dpi
+    return cv2.resize(page, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def iter_survey_pages(pdfs, pages, dpi=RENDER_DPI, skew=0.0, noise=3.0, seed=0):
+    """Yield (pdf index, page number, page array, answers, applied skew) for a seeded batch.
+
+    Each page gets a skew drawn uniformly from [-skew, skew].
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(1, pdfs + 1):
+        for j in range(1, pages + 1):
+            answers = random_answers(rng)
+            page_skew = float(rng.uniform(-skew, skew)) if skew else 0.0
+            yield i, j, render_page(answers, dpi, page_skew, noise, rng), answers, page_skew
+
+def write_batch(output_directory, pdfs, pages, dpi=RENDER_DPI, skew=0.0, noise=3.0, seed=0):
+    """Write the batch as PDFs plus ground_truth.json; returns the ground truth."""
+    os.makedirs(output_directory, exist_ok=True)
+    truth = {}
+    pending = []
+    for i, j, page, answers, page_skew in iter_survey_pages(pdfs, pages, dpi, skew, noise, seed):
+        filename = f"survey_{i:03d}.pdf"
+        pending.append(Image.fromarray(page))
+        truth.setdefault(filename, []).append({'answers': answers, 'skew': page_skew})
+        if j == pages:
+            pending[0].save(os.path.join(output_directory, filename), save_all=True,
+                            append_images=pending[1:], resolution=dpi)
+            pending = []
+
+    with open(os.path.join(output_directory, 'ground_truth.json'), 'w') as f:
+        json.dump(truth, f, indent=4)
+    return truth
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--pdfs', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=2)
+    parser.add_argument('--dpi', type=int, default=RENDER_DPI)
+    parser.add_argument('--skew', type=float, default=2.0, help="maximum skew in degrees")
+    parser.add_argument('--noise', type=float, default=3.0, help="standard deviation of the pixel noise")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_batch(args.output_dir, args.pdfs, args.pages, args.dpi, args.skew, args.noise, args.seed)
+    print(f"Wrote {args.pdfs} PDFs of {args.pages} pages to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,20 @@
 import cv2
 import numpy as np
 import os
-import json
 import configparser
 
+
+from band_store import BandStore
+import cropper
+from debug_writer import get_debug_writer
+from form_template import FormTemplate
+from intermediate import list_pages, prepare_output, read_page, write_page
+import metrics
+from page_cache import array_digest, file_digest, stage_key
+from page_image import to_bgr, to_gray
+from parallel import map_ordered
+from resolution import pixels, pyramid_factor, pyramid_level
+
 # Get the absolute path to the script's directory
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Get the parent directory (project root)
@@ -15,6 +26,30 @@ config_path = os.path.join(project_root, 'config', 'config.ini')
 config = configparser.ConfigParser()
 config.read(config_path)
 
+# page detects the bands of every page; template detects them once and registers pages to them
+layout_mode = config.get('aligner', 'layout_mode', fallback='page')
+
+# Config values the alignment stage depends on (used in cache keys)
+STAGE_PARAMS = [
+    ('aligner', 'angle_range'),
+    ('aligner', 'angle_step'),
+    ('aligner', 'deskew_method'),
+    ('aligner', 'deskew_scale'),
+    ('aligner', 'deskew_coarse_step'),
+    ('aligner', 'rotation_tolerance'),
+    ('aligner', 'horizontal_band_threshold'),
+    ('aligner', 'min_band_gap'),
+    ('aligner', 'layout_mode'),
+    ('aligner', 'max_shift'),
+    ('aligner', 'analysis_dpi'),
+    ('cropper', 'dpi'),
+    ('cropper', 'reference_dpi'),
+    ('questions', 'number_of_grades')
+]
+
+def stage_params():
+    return {f"{section}.{key}": config.get(section, key, fallback=None) for section, key in STAGE_PARAMS}
+
 def rotate_image(image, angle):
     height, width = image.shape[:2]
     center = (width // 2, height // 2)
@@ -22,8 +57,84 @@ def rotate_image(image, angle):
     rotated = cv2.warpAffine(image, rotation_matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
     return rotated
 
-def find_best_rotation(image, angle_range=20, angle_step=0.1):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def find_best_rotation(image, angle_range=20, angle_step=0.1, factor=1):
+    """Skew angle of a page; factor is how much image is already downscaled from the full page."""
+    method = config.get('aligner', 'deskew_method', fallback='projection')
+    if method == 'hough':
+        return find_best_rotation_hough(image, angle_range, angle_step)
+    gray = to_gray(image)
+    return find_best_rotation_projection(
+        gray, angle_range, angle_step,
+        coarse_step=config.getfloat('aligner', 'deskew_coarse_step', fallback=1.0),
+        scale=min(config.getfloat('aligner', 'deskew_scale', fallback=0.25) * factor, 1.0)
+    )
+
+def ink_coordinates(gray):
+    """Coordinates of the dark pixels (Otsu threshold) relative to the image centre."""
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(ink)
+    height, width = gray.shape
+    return xs.astype(np.float64) - width // 2, ys.astype(np.float64) - height // 2
+
+def projection_score(xs, ys, angle):
+    """Sharpness of the row profile of the ink once rotated by angle (as rotate_image would)."""
+    theta = np.radians(angle)
+    rows = np.round(ys * np.cos(theta) - xs * np.sin(theta)).astype(np.int64)
+    profile = np.bincount(rows - rows.min())
+    return np.sum(np.diff(profile).astype(np.float64) ** 2)
+
+def best_projection_angle(xs, ys, angles):
+    scores = [projection_score(xs, ys, angle) for angle in angles]
+    return float(angles[int(np.argmax(scores))])
+
+def ink_profiles(gray):
+    """Number of dark pixels (Otsu threshold) in every row and every column."""
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return ink.sum(axis=1, dtype=np.int64), ink.sum(axis=0, dtype=np.int64)
+
+def profile_shift(reference, profile, max_shift):
+    """Offset of profile relative to reference that best lines them up, at most max_shift either way."""
+    reference = reference - reference.mean()
+    profile = profile - profile.mean()
+    correlation = np.correlate(profile, reference, 'full')
+    lags = np.arange(-(len(reference) - 1), len(profile))
+    within = np.abs(lags) <= max_shift
+    return int(lags[within][np.argmax(correlation[within])])
+
+def shift_image(image, dx, dy):
+    """Move the content at (x, y) to (x - dx, y - dy), filling the uncovered edge with white."""
+    height, width = image.shape[:2]
+    shifted = np.full_like(image, 255)
+    shifted[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)] = \
+        image[max(dy, 0):height - max(-dy, 0), max(dx, 0):width - max(-dx, 0)]
+    return shifted
+
+def find_best_rotation_projection(gray, angle_range=20, angle_step=0.5, coarse_step=1.0, scale=0.25):
+    """Coarse-to-fine projection-profile deskew.
+
+    The coarse search covers [-angle_range, angle_range] every coarse_step
+    degrees on a copy downscaled by scale; the refinement searches one coarse
+    step either side of that estimate every angle_step degrees at full
+    resolution. Returns the angle to pass to rotate_image.
+    """
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    xs, ys = ink_coordinates(small)
+    if len(xs) == 0:
+        print("No ink detected. Returning 0 degrees rotation.")
+        return 0
+
+    coarse_step = max(coarse_step, angle_step)
+    coarse_angles = np.arange(-angle_range, angle_range + coarse_step / 2, coarse_step)
+    coarse_angle = best_projection_angle(xs, ys, coarse_angles)
+
+    low = max(coarse_angle - coarse_step, -angle_range)
+    high = min(coarse_angle + coarse_step, angle_range)
+    fine_angles = np.arange(low, high + angle_step / 2, angle_step)
+    xs, ys = ink_coordinates(gray)
+    return best_projection_angle(xs, ys, fine_angles)
+
+def find_best_rotation_hough(image, angle_range=20, angle_step=0.1):
+    gray = to_gray(image)
     
     # Apply Gaussian blur to reduce noise
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
@@ -36,7 +147,7 @@ def find_best_rotation(image, angle_range=20, angle_step=0.1):
     dilated_edges = cv2.dilate(edges, kernel, iterations=1)
     
     # Adjust HoughLines parameters
-    lines = cv2.HoughLines(dilated_edges, 1, np.pi/180, 100)
+    lines = cv2.HoughLines(dilated_edges, 1, np.radians(angle_step), 100)
     
     if lines is None:
         print("No lines detected. Returning 0 degrees rotation.")
@@ -59,57 +170,66 @@ def find_best_rotation(image, angle_range=20, angle_step=0.1):
     
     return best_angle
 
-def find_content_margins(image, threshold=30):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def column_gradient_max(gray):
+    """Largest absolute vertical intensity step in every column."""
+    return np.abs(np.diff(gray.astype(np.int16), axis=0)).max(axis=0)
+
+def find_content_margins(image, threshold=30, padding=10):
+    gray = to_gray(image)
     height, width = gray.shape
+    half = width // 2
+    has_content = column_gradient_max(gray) > threshold
+
+    # The first column scanned from each edge only counts from offset 1 inwards,
+    # since offset 0 is indistinguishable from "not found yet".
+    left_hits = np.flatnonzero(has_content[1:half]) + 1
+    right_hits = np.flatnonzero(has_content[width - 2:width - 1 - half:-1]) + 1
+
+    left_margin = int(left_hits[0]) if len(left_hits) else 0
+    right_margin = width - 1 - int(right_hits[0]) if len(right_hits) else width - 1
     
-    def compute_gradient(column):
-        return np.abs(np.diff(column.astype(np.float32)))
-    
-    left_margin = 0
-    right_margin = width - 1
-    
-    for x in range(width // 2):
-        left_gradient = compute_gradient(gray[:, x])
-        right_gradient = compute_gradient(gray[:, width - 1 - x])
-        
-        if left_margin == 0 and np.max(left_gradient) > threshold:
-            left_margin = x
-        
-        if right_margin == width - 1 and np.max(right_gradient) > threshold:
-            right_margin = width - 1 - x
-        
-        if left_margin != 0 and right_margin != width - 1:
-            break
-    
-    return left_margin-10, right_margin+10
+    return left_margin-padding, right_margin+padding
 
-def detect_horizontal_bands(image, left_margin, right_margin):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = gray.shape
+def pick_band_peaks(row_values, threshold, min_gap):
+    """Rows strictly inside the page whose value exceeds threshold, at least min_gap apart.
+
+    Rows are taken greedily from the top starting after row 0, the same as a
+    row-by-row scan, but only the rows above threshold are ever visited.
+    """
+    height = len(row_values)
+    candidates = np.flatnonzero(row_values[1:height - 1] > threshold) + 1
+
+    bands = [0]
+    index = np.searchsorted(candidates, max(min_gap, 1))
+    while index < len(candidates):
+        y = int(candidates[index])
+        bands.append(y)
+        index = np.searchsorted(candidates, y + max(min_gap, 1))
+
+    if bands[-1] != height - 1:
+        bands.append(height - 1)
+
+    return bands
+
+def edge_row_sums(gray, left_margin, right_margin):
+    """Canny edge response of the content area summed along each row."""
     content = gray[:, left_margin:right_margin]
     
     # Apply edge detection
     edges = cv2.Canny(content, 50, 150)
     
     # Sum the edge detection results horizontally
-    edge_sum = np.sum(edges, axis=1)
+    return np.sum(edges, axis=1)
+
+def detect_horizontal_bands(image, left_margin, right_margin):
+    gray = to_gray(image)
+    edge_sum = edge_row_sums(gray, left_margin, right_margin)
     
     # Get threshold values from config
     threshold = config.getint('aligner', 'horizontal_band_threshold')
-    min_gap = config.getint('aligner', 'min_band_gap')
+    min_gap = pixels(config.getint('aligner', 'min_band_gap'))
 
-    bands = [0]
-    last_band = 0
-    for y in range(1, height - 1):
-        if edge_sum[y] > threshold * (right_margin - left_margin) and y - last_band >= min_gap:
-            bands.append(y)
-            last_band = y
-    
-    if bands[-1] != height - 1:
-        bands.append(height - 1)
-    
-    return bands
+    return pick_band_peaks(edge_sum, threshold * (right_margin - left_margin), min_gap)
 
 def create_grade_bands(left_margin, right_margin, num_grades):
     content_width = right_margin - left_margin
@@ -121,81 +241,295 @@ def create_grade_bands(left_margin, right_margin, num_grades):
     
     return bands
 
-def align_questionnaire(input_path, output_path, debug_path, bands_dict):
-    image = cv2.imread(input_path)
-    if image is None:
-        print(f"Error: Failed to load image: {input_path}")
-        return
+def deskew_image(image):
+    """Find the skew of a cropped page on its analysis level and rotate the page upright.
 
+    Returns the angle, the rotated page, the rotated analysis level (the page
+    itself unless [aligner] analysis_dpi is set) and the level's downscale factor.
+    """
     angle_range = config.getfloat('aligner', 'angle_range')
     angle_step = config.getfloat('aligner', 'angle_step')
-    best_angle = find_best_rotation(image, angle_range, angle_step)
-    print(f"Best rotation angle: {best_angle:.2f} degrees")
+    factor = pyramid_factor()
+    with metrics.span('pyramid'):
+        level = pyramid_level(to_gray(image), factor)
+    with metrics.span('deskew'):
+        best_angle = find_best_rotation(level, angle_range, angle_step, factor)
+        print(f"Best rotation angle: {best_angle:.2f} degrees")
+
+        # Most pages need no rotation; skip the warp when the skew is negligible
+        if abs(best_angle) < config.getfloat('aligner', 'rotation_tolerance', fallback=0.0):
+            rotated, rotated_level = image, level
+        else:
+            rotated = rotate_image(image, best_angle)
+            rotated_level = rotate_image(level, best_angle) if factor > 1 else rotated
+    return best_angle, rotated, rotated_level, factor
 
-    rotated = rotate_image(image, best_angle)
-    left_margin, right_margin = find_content_margins(rotated)
+def level_margins(level, factor):
+    """Content margins found on an analysis level, in full page columns."""
+    left, right = find_content_margins(level, padding=0)
+    return left * factor - pixels(10), right * factor + factor - 1 + pixels(10)
+
+def level_bands(rotated, level, factor, left_margin, right_margin):
+    """Horizontal bands of a rotated page, located on its analysis level and measured at full resolution.
+
+    Rows whose edge response on the level exceeds the threshold (a reduced
+    page responds more strongly, not less) mark the candidate stretches of
+    the page; the full resolution edge response is computed for those rows
+    and their neighbours only, and bands are picked from it as
+    detect_horizontal_bands picks them.
+    """
+    if factor == 1:
+        return detect_horizontal_bands(rotated, left_margin, right_margin)
+
+    gray = to_gray(rotated)
+    height = gray.shape[0]
+    threshold = config.getint('aligner', 'horizontal_band_threshold')
+    min_gap = pixels(config.getint('aligner', 'min_band_gap'))
+    level_left, level_right = left_margin // factor, right_margin // factor
+    level_sum = edge_row_sums(to_gray(level), level_left, level_right)
+    candidates = np.flatnonzero(level_sum > threshold * (level_right - level_left))
+
+    # The runs, each with two rows of context either side, go through the edge detector as one stacked strip
+    runs = candidate_runs(candidates, factor, height)
+    edge_sum = np.zeros(height, dtype=np.int64)
+    if runs:
+        spans = [(max(start - 2, 0), min(stop + 2, height)) for start, stop in runs]
+        stacked_sum = edge_row_sums(np.concatenate([gray[low:high] for low, high in spans]), left_margin, right_margin)
+        offset = 0
+        for (start, stop), (low, high) in zip(runs, spans):
+            edge_sum[start:stop] = stacked_sum[offset + start - low:offset + stop - low]
+            offset += high - low
+    return pick_band_peaks(edge_sum, threshold * (right_margin - left_margin), min_gap)
+
+def candidate_runs(rows, factor, height):
+    """Merged (start, stop) full resolution row ranges covering each level row and its neighbours."""
+    runs = []
+    for row in rows.tolist():
+        start, stop = max((row - 1) * factor, 0), min((row + 2) * factor, height)
+        if runs and start <= runs[-1][1]:
+            runs[-1][1] = max(runs[-1][1], stop)
+        else:
+            runs.append([start, stop])
+    return runs
+
+def align_image(image, template=None):
+    """Deskew a cropped page and detect its grade bands.
+
+    Returns the rotated image and a layout dict holding the rotation angle,
+    the content margins and the vertical/horizontal bands. With a template
+    the page is registered to it instead and gets the template's bands.
+    Margins and bands are found on the analysis level and given in full
+    page pixels.
+    """
+    if template is not None:
+        return register_image(image, template)
+
+    best_angle, rotated, level, factor = deskew_image(image)
+
+    with metrics.span('margins'):
+        left_margin, right_margin = level_margins(level, factor)
     
     num_grades = config.getint('questions', 'number_of_grades')
     vertical_bands = create_grade_bands(left_margin, right_margin, num_grades)
-    horizontal_bands = detect_horizontal_bands(rotated, left_margin, right_margin)
-    
-    # Create debug image
-    debug_image = rotated.copy()
-    for i, x in enumerate(vertical_bands):
+    with metrics.span('bands'):
+        horizontal_bands = level_bands(rotated, level, factor, left_margin, right_margin)
+
+    layout = {
+        'angle': best_angle,
+        'left_margin': left_margin,
+        'right_margin': right_margin,
+        'vertical': vertical_bands,
+        'horizontal': horizontal_bands
+    }
+    return rotated, layout
+
+def register_image(image, template):
+    """Deskew a cropped page and shift it onto a form template.
+
+    The shift lines the page's ink row and column profiles up with the
+    template's. Returns the registered image and the template's layout with
+    this page's angle and shift.
+    """
+    best_angle, rotated, _, _ = deskew_image(image)
+
+    with metrics.span('register'):
+        max_shift = pixels(config.getint('aligner', 'max_shift', fallback=200))
+        rows, columns = ink_profiles(to_gray(rotated))
+        dx = profile_shift(template.columns, columns, max_shift)
+        dy = profile_shift(template.rows, rows, max_shift)
+        registered = rotated if dx == 0 and dy == 0 else shift_image(rotated, dx, dy)
+
+    layout = {**template.layout, 'angle': best_angle, 'shift': [dx, dy]}
+    return registered, layout
+
+def draw_alignment_debug(rotated, layout, scale=1.0):
+    """The page with its bands drawn on it, at the given scale of the page."""
+    num_grades = len(layout['vertical']) - 1
+    left_margin = round(layout['left_margin'] * scale)
+    right_margin = round(layout['right_margin'] * scale)
+
+    debug_image = to_bgr(rotated, scale)
+    for i, x in enumerate(layout['vertical']):
+        x = round(x * scale)
         cv2.line(debug_image, (x, 0), (x, debug_image.shape[0]), (0, 255, 0), 2)
         if i < num_grades:
             cv2.putText(debug_image, str(i+1), (x + 10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
     
-    for i, y in enumerate(horizontal_bands):
+    for i, y in enumerate(layout['horizontal']):
+        y = round(y * scale)
         cv2.line(debug_image, (left_margin, y), (right_margin, y), (255, 0, 0), 2)
         cv2.putText(debug_image, str(i), (left_margin - 40, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
 
+    return debug_image
+
+def band_entry(layout):
+    """The subset of a layout stored in the band store."""
+    return {
+        'vertical': layout['vertical'],
+        'horizontal': layout['horizontal']
+    }
+
+def align_questionnaire(input_path, output_path, debug_path, band_store=None):
+    """Align one PNG and return its band entry (None if it failed to load).
+
+    The entry is also written to band_store when one is given; parallel callers
+    should leave it out and store the returned entries themselves. No debug
+    image is drawn when debug_path is None.
+    """
+    image = read_page(input_path)
+    if image is None:
+        print(f"Error: Failed to load image: {input_path}")
+        return None
+
+    rotated, layout = align_image(image, get_template())
+
     # Save aligned and debug images
-    cv2.imwrite(output_path, rotated)
-    cv2.imwrite(debug_path, debug_image)
+    write_page(output_path, rotated)
     print(f"Aligned image saved: {output_path}")
-    print(f"Debug image saved: {debug_path}")
+    if debug_path is not None:
+        debug_writer = get_debug_writer()
+        debug_writer.write(debug_path, draw_alignment_debug(rotated, layout, debug_writer.scale), scaled=True)
+        print(f"Debug image saved: {debug_writer.path(debug_path)}")
     
     # Save band information
-    bands_dict[os.path.basename(output_path)] = {
-        'vertical': vertical_bands,
-        'horizontal': horizontal_bands
-    }
+    entry = band_entry(layout)
+    if band_store is not None:
+        band_store.put(os.path.basename(output_path), entry)
+    return entry
+
+def align_questionnaire_task(paths):
+    return align_questionnaire(*paths)
+
+def band_store_path():
+    return os.path.join(project_root, config.get('paths', 'json_dir'),
+                        config.get('paths', 'band_store', fallback='detected_grade_bands.sqlite'))
+
+def open_band_store():
+    os.makedirs(os.path.join(project_root, config.get('paths', 'json_dir')), exist_ok=True)
+    return BandStore(band_store_path())
+
+def template_path():
+    return os.path.join(project_root, config.get('paths', 'json_dir'),
+                        config.get('paths', 'template', fallback='form_template.npz'))
+
+def build_template(image, key=None):
+    """Align a reference page and record its layout and ink profiles as a template."""
+    rotated, layout = align_image(image)
+    rows, columns = ink_profiles(to_gray(rotated))
+    return FormTemplate(layout, rows, columns, key)
+
+def load_reference_page(path):
+    """The reference form as a cropped page: the first page of a PDF is cropped like the cropper does, images are used as they are."""
+    if path.lower().endswith('.pdf'):
+        return cropper.crop_pdf_page(path, 1)[0]
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+form_template = None
+
+def get_template():
+    """The form template in template mode (loaded once per process), otherwise None."""
+    global form_template
+    if layout_mode != 'template':
+        return None
+    if form_template is None:
+        form_template = FormTemplate.load(template_path())
+    return form_template
+
+def prepare_template(first_page=None):
+    """Load the form template, building it again if its reference or parameters changed.
+
+    The reference is [aligner] template_reference when set, otherwise
+    first_page (a cropped page). Returns None outside template mode.
+    """
+    global form_template
+    if layout_mode != 'template':
+        return None
+
+    reference = config.get('aligner', 'template_reference', fallback='')
+    if reference:
+        reference_path = os.path.join(project_root, reference)
+        digest = file_digest(reference_path)
+    elif first_page is not None:
+        digest = array_digest(first_page)
+    else:
+        raise ValueError("Template mode needs [aligner] template_reference or a first page to build the template from")
+
+    key = stage_key('template', digest, {**stage_params(), **cropper.stage_params()})
+    template = FormTemplate.load(template_path())
+    if template is None or template.key != key:
+        image = load_reference_page(reference_path) if reference else first_page
+        template = build_template(image, key)
+        template.save(template_path())
+        print(f"Form template saved: {template_path()} ({len(template.layout['horizontal'])} horizontal bands)")
+    form_template = template
+    return template
+
+def export_bands_json(band_store):
+    """Also write the legacy detected_grade_bands.json when enabled in [paths]."""
+    if not config.getboolean('paths', 'export_bands_json', fallback=False):
+        return None
+    json_path = os.path.join(project_root, config.get('paths', 'json_dir'), 'detected_grade_bands.json')
+    band_store.export_json(json_path)
+    return json_path
 
 # Main execution
 if __name__ == "__main__":
     input_directory = os.path.join(project_root, config.get('aligner', 'input_dir'))
     output_directory = os.path.join(project_root, config.get('aligner', 'output_dir'))
     debug_directory = os.path.join(project_root, config.get('aligner', 'debug_dir'))
-    json_directory = os.path.join(project_root, config.get('paths', 'json_dir'))
 
     print(f"Input directory: {input_directory}")
     print(f"Output directory: {output_directory}")
     print(f"Debug directory: {debug_directory}")
 
     # Ensure output directories exist
-    os.makedirs(output_directory, exist_ok=True)
+    prepare_output(output_directory)
     os.makedirs(debug_directory, exist_ok=True)
-    os.makedirs(json_directory, exist_ok=True)
 
-    # Get all PNG files in the input directory
-    png_files = [f for f in os.listdir(input_directory) if f.endswith('.png')]
-    png_files.sort()
+    # Get all pages in the input directory
+    png_files = list_pages(input_directory)
 
-    bands_dict = {}
+    workers = config.getint('pipeline', 'workers', fallback=1)
+    debug_writer = get_debug_writer()
 
     if png_files:
-        for filename in png_files:
-            input_path = os.path.join(input_directory, filename)
-            output_path = os.path.join(output_directory, f"aligned_{filename}")
-            debug_path = os.path.join(debug_directory, f"debug_{filename}")
-            align_questionnaire(input_path, output_path, debug_path, bands_dict)
-
-        # Save bands to JSON file with proper formatting
-        json_path = os.path.join(json_directory, 'detected_grade_bands.json')
-        with open(json_path, 'w') as f:
-            json.dump(bands_dict, f, indent=4)
-        print(f"Grade bands saved to: {json_path}")
+        if layout_mode == 'template':
+            prepare_template(read_page(os.path.join(input_directory, png_files[0])))
+
+        tasks = [
+            (os.path.join(input_directory, filename),
+             os.path.join(output_directory, f"aligned_{filename}"),
+             os.path.join(debug_directory, f"debug_{filename}") if debug_writer.wants(i) else None)
+            for i, filename in enumerate(png_files)
+        ]
+        # Entries come back in file order and are stored here only, each as soon as it is done
+        with open_band_store() as band_store:
+            for (_, output_path, _), entry in zip(tasks, map_ordered(align_questionnaire_task, tasks, workers)):
+                if entry is not None:
+                    band_store.put(os.path.basename(output_path), entry)
+            export_bands_json(band_store)
+        debug_writer.close()
+        print(f"Grade bands saved to: {band_store.path}")
 
         print(f"Alignment completed. {len(png_files)} images processed.")
     else:
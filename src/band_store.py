@@ -0,0 +1,62 @@
+"""Indexed store for detected grade bands.
+
+Bands are kept in a SQLite database (one row per aligned page, in WAL mode)
+so the aligner can write each page as soon as it is done and the OCR stage,
+possibly running at the same time, can look pages up individually.
+"""
+import json
+import sqlite3
+
+class BandStore:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bands ('
+            'page TEXT PRIMARY KEY, vertical TEXT NOT NULL, horizontal TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def put(self, page, entry):
+        """Store (or replace) the band entry of one page and commit it immediately."""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO bands (page, vertical, horizontal) VALUES (?, ?, ?)',
+            (page, json.dumps(entry['vertical']), json.dumps(entry['horizontal']))
+        )
+        self.connection.commit()
+
+    def get(self, page):
+        """The band entry of one page, or None if it has not been stored."""
+        row = self.connection.execute(
+            'SELECT vertical, horizontal FROM bands WHERE page = ?', (page,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'vertical': json.loads(row[0]), 'horizontal': json.loads(row[1])}
+
+    def pages(self):
+        return [row[0] for row in self.connection.execute('SELECT page FROM bands ORDER BY page')]
+
+    def items(self):
+        for page, vertical, horizontal in self.connection.execute(
+                'SELECT page, vertical, horizontal FROM bands ORDER BY page'):
+            yield page, {'vertical': json.loads(vertical), 'horizontal': json.loads(horizontal)}
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM bands').fetchone()[0]
+
+    def export_json(self, json_path):
+        """Write the whole store in the legacy detected_grade_bands.json layout."""
+        with open(json_path, 'w') as f:
+            json.dump(dict(self.items()), f, indent=4)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,10 +1,16 @@
-from PIL import Image
 import os
-from pdf2image import convert_from_path
+import tempfile
+from pdf2image import convert_from_path, pdfinfo_from_path
 import configparser
 import cv2
 import numpy as np
 
+from debug_writer import get_debug_writer
+import embedded_image
+from intermediate import prepare_output, write_page
+import metrics
+from resolution import dpi, pixels
+
 # Get the absolute path to the script's directory
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Get the parent directory (project root)
@@ -21,72 +27,178 @@ input_directory = os.path.join(project_root, config.get('cropper', 'input_dir'))
 output_directory = os.path.join(project_root, config.get('cropper', 'output_dir'))
 debug_directory = os.path.join(project_root, config.get('cropper', 'debug_dir'))
 
-# Define the rectangle size
-rect_width = config.getint('cropper', 'rect_width')
-rect_height = config.getint('cropper', 'rect_height')
-
-# Ensure the output and debug directories exist
-os.makedirs(output_directory, exist_ok=True)
-os.makedirs(debug_directory, exist_ok=True)
-
-def convert_pdf_to_png(pdf_path, output_directory):
-    pages = convert_from_path(pdf_path)
-    png_paths = []
-    for i, page in enumerate(pages):
-        png_path = os.path.join(output_directory, f'page_{i+1}.png')
-        page.save(png_path, 'PNG')
-        png_paths.append(png_path)
-    return png_paths
-
-def crop_image(input_path, output_path, debug_path, rect_width, rect_height):
-    with Image.open(input_path) as img:
-        width, height = img.size
-        
-        # Calculate the dimensions for the rectangle
-        rect_width = min(rect_width, width)  # Ensure rect_width doesn't exceed image width
-        rect_height = min(rect_height, height)  # Ensure rect_height doesn't exceed image height
-        
-        left = width - rect_width  # Align to right border
-        bottom = (height + rect_height) // 2  # Center vertically
-        right = width
-        top = bottom - rect_height
-
-        # Crop the image
-        cropped_img = img.crop((left, top, right, bottom))
-        
-        # Save the cropped image
-        cropped_img.save(output_path)
-
-        # Create debug image
-        debug_img = cv2.imread(input_path)
-        cv2.rectangle(debug_img, (left, top), (right, bottom), (0, 255, 0), 2)
-        cv2.imwrite(debug_path, debug_img)
-
-# Get all PDF files in the input directory
-pdf_files = [f for f in os.listdir(input_directory) if f.endswith('.pdf')]
-
-# Sort the files to ensure consistent numbering
-pdf_files.sort()
-
-# Iterate over each PDF in the input directory
-for i, filename in enumerate(pdf_files, start=1):
-    # Construct full input path
-    input_path = os.path.join(input_directory, filename)
-    
-    # Convert PDF to PNG
-    png_paths = convert_pdf_to_png(input_path, output_directory)
-    
-    # Crop each converted PNG
-    for j, png_path in enumerate(png_paths, start=1):
-        output_filename = f'questionnaire_{i}_page_{j}.png'
-        output_path = os.path.join(output_directory, output_filename)
-        debug_filename = f'debug_questionnaire_{i}_page_{j}.png'
-        debug_path = os.path.join(debug_directory, debug_filename)
-        
-        # Crop the image
-        crop_image(png_path, output_path, debug_path, rect_width, rect_height)
-        
-        # Remove the temporary full-page PNG
-        os.remove(png_path)
-
-print(f"Conversion and cropping completed. {len(pdf_files)} PDFs processed.")
\ No newline at end of file
+# Define the rectangle size (in pixels at the render resolution)
+rect_width = pixels(config.getint('cropper', 'rect_width'))
+rect_height = pixels(config.getint('cropper', 'rect_height'))
+
+# Number of pages rendered at once (0 renders the whole PDF in one go)
+render_window = config.getint('cropper', 'render_window', fallback=1)
+
+# auto takes the embedded image of single-image (scanned) pages and renders the others; render renders every page
+ingest = config.get('cropper', 'ingest', fallback='auto')
+
+def list_pdf_files(directory):
+    # Sort the files to ensure consistent numbering
+    return sorted(f for f in os.listdir(directory) if f.endswith('.pdf'))
+
+def stage_params():
+    """Config values the crop stage depends on (used in cache keys)."""
+    return {'rect_width': rect_width, 'rect_height': rect_height, 'dpi': dpi, 'ingest': ingest}
+
+def page_windows(page_numbers, window):
+    """Group sorted page numbers into runs of consecutive pages at most window long."""
+    windows = []
+    for page_number in page_numbers:
+        if windows and page_number == windows[-1][1] + 1 and (window <= 0 or page_number - windows[-1][0] < window):
+            windows[-1][1] = page_number
+        else:
+            windows.append([page_number, page_number])
+    return windows
+
+def iter_pdf_pages(pdf_path, window=1, page_numbers=None):
+    """Render a PDF a window of pages at a time, yielding (page number, PIL page).
+
+    Peak memory is bounded by the window size instead of the PDF length.
+    When page_numbers is given only those pages are rendered.
+    """
+    if page_numbers is not None:
+        windows = page_windows(sorted(page_numbers), window)
+    elif window <= 0:
+        windows = [(1, None)]
+    else:
+        page_count = pdfinfo_from_path(pdf_path)['Pages']
+        windows = [(first, min(first + window - 1, page_count)) for first in range(1, page_count + 1, window)]
+
+    for first, last in windows:
+        with metrics.span('render'):
+            pages = convert_from_path(pdf_path, dpi=dpi, first_page=first, last_page=last, grayscale=True)
+        page_number = first
+        # Hand pages over one by one so each is released once the consumer is done
+        while pages:
+            yield page_number, pages.pop(0)
+            page_number += 1
+
+def iter_cropped_pages(pdf_path, rect_width, rect_height, window=1, debug=False, page_numbers=None, debug_scale=1.0):
+    """Stream the cropped regions of a PDF, yielding (page number, cropped grayscale array, debug image).
+
+    debug is a bool or a callable taking the page number. The debug image is
+    None unless debug is set for the page; it is drawn (at debug_scale) while
+    the full page is still in memory so the page never has to be re-read.
+    """
+    if ingest != 'auto':
+        for page_number, page in iter_pdf_pages(pdf_path, window, page_numbers):
+            page_debug = debug(page_number) if callable(debug) else debug
+            yield page_number, *crop_rendered_page(page, rect_width, rect_height, page_debug, debug_scale)
+        return
+
+    if page_numbers is None:
+        page_numbers = range(1, pdfinfo_from_path(pdf_path)['Pages'] + 1)
+    page_numbers = sorted(page_numbers)
+    scans = find_page_scans(pdf_path, page_numbers)
+    # Pages that are not a single scanned image are rendered as usual, in page order with the others
+    rendered = iter_pdf_pages(pdf_path, window, [j for j in page_numbers if j not in scans])
+    for page_number in page_numbers:
+        page_debug = debug(page_number) if callable(debug) else debug
+        if page_number in scans:
+            yield page_number, *crop_scan(pdf_path, scans[page_number], rect_width, rect_height, page_debug, debug_scale)
+        else:
+            _, page = next(rendered)
+            yield page_number, *crop_rendered_page(page, rect_width, rect_height, page_debug, debug_scale)
+
+def find_page_scans(pdf_path, page_numbers):
+    """{page number: PageScan} for the given pages that can be cropped from their embedded image."""
+    if not page_numbers:
+        return {}
+    with metrics.span('extract'):
+        scans = embedded_image.find_page_scans(pdf_path, min(page_numbers), max(page_numbers), dpi)
+    return {j: scans[j] for j in page_numbers if j in scans}
+
+def crop_scan(pdf_path, scan, rect_width, rect_height, debug=False, debug_scale=1.0):
+    """Crop a page straight from its embedded image, as if it had been rendered at dpi."""
+    with tempfile.TemporaryDirectory() as directory:
+        with metrics.span('extract'):
+            path = embedded_image.extract_image(pdf_path, scan.page, directory)
+        with metrics.span('crop'):
+            box = crop_box(*scan.render_size, rect_width, rect_height)
+            cropped = embedded_image.read_region(path, scan, box)
+        debug_image = draw_crop_debug(embedded_image.read_page(path, scan), box, debug_scale) if debug else None
+    return cropped, debug_image
+
+def crop_pdf_page(pdf_path, page_number, debug=False, debug_scale=1.0):
+    """Cropped region and debug image of a single PDF page, from its embedded image when ingest allows."""
+    scans = find_page_scans(pdf_path, [page_number]) if ingest == 'auto' else {}
+    if page_number in scans:
+        return crop_scan(pdf_path, scans[page_number], rect_width, rect_height, debug, debug_scale)
+    with metrics.span('render'):
+        page = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, grayscale=True)[0]
+    return crop_rendered_page(page, rect_width, rect_height, debug, debug_scale)
+
+def crop_box(width, height, rect_width, rect_height):
+    # Calculate the dimensions for the rectangle
+    rect_width = min(rect_width, width)  # Ensure rect_width doesn't exceed image width
+    rect_height = min(rect_height, height)  # Ensure rect_height doesn't exceed image height
+
+    left = width - rect_width  # Align to right border
+    bottom = (height + rect_height) // 2  # Center vertically
+    right = width
+    top = bottom - rect_height
+    return left, top, right, bottom
+
+def crop_page(page, rect_width, rect_height):
+    """Crop a rendered PIL page in memory and return it as a grayscale array with its crop box."""
+    with metrics.span('crop'):
+        box = crop_box(page.width, page.height, rect_width, rect_height)
+        cropped = page.crop(box)
+        if cropped.mode == 'L':
+            return np.array(cropped), box
+        return cv2.cvtColor(np.asarray(cropped.convert('RGB')), cv2.COLOR_RGB2GRAY), box
+
+def draw_crop_debug(page, box, scale=1.0):
+    """Full page with the crop box drawn on it, rendered directly at the given scale."""
+    if scale < 1:
+        # Integer reduction box-filters while decimating, much cheaper than a full-size copy
+        factor = max(int(round(1 / scale)), 1)
+        page = page.reduce(factor)
+        box = tuple(v // factor for v in box)
+    debug_img = cv2.cvtColor(np.asarray(page.convert('RGB')), cv2.COLOR_RGB2BGR)
+    cv2.rectangle(debug_img, box[:2], box[2:], (0, 255, 0), 2)
+    return debug_img
+
+def crop_rendered_page(page, rect_width, rect_height, debug=False, debug_scale=1.0):
+    cropped, box = crop_page(page, rect_width, rect_height)
+    debug_image = draw_crop_debug(page, box, debug_scale) if debug else None
+    return cropped, debug_image
+
+def page_name(questionnaire_index, page_index):
+    return f'questionnaire_{questionnaire_index}_page_{page_index}.png'
+
+# Main execution
+if __name__ == "__main__":
+    # Ensure the output and debug directories exist
+    prepare_output(output_directory)
+    os.makedirs(debug_directory, exist_ok=True)
+
+    # Get all PDF files in the input directory
+    pdf_files = list_pdf_files(input_directory)
+    debug_writer = get_debug_writer()
+    pages_before = 0
+
+    # Iterate over each PDF in the input directory
+    for i, filename in enumerate(pdf_files, start=1):
+        # Construct full input path
+        input_path = os.path.join(input_directory, filename)
+
+        # Render and crop the pages a window at a time
+        wants_debug = lambda j, offset=pages_before: debug_writer.wants(offset + j - 1)
+        pages = iter_cropped_pages(input_path, rect_width, rect_height, render_window,
+                                   debug=wants_debug, debug_scale=debug_writer.scale)
+        for j, cropped, debug_image in pages:
+            output_filename = page_name(i, j)
+            write_page(os.path.join(output_directory, output_filename), cropped)
+            if debug_image is not None:
+                debug_writer.write(os.path.join(debug_directory, f'debug_{output_filename}'), debug_image, scaled=True)
+            pages_before += 1
+
+    debug_writer.close()
+
+    print(f"Conversion and cropping completed. {len(pdf_files)} PDFs processed.")
@@ -0,0 +1,116 @@
+"""Debug image policy and background writer.
+
+The [debug] level decides which pages get debug images: off, sampled (every
+sample_every-th page and/or low-confidence pages) or full. Images can be
+downscaled and written as JPEG, and are encoded on a background thread so
+the main path never waits on PNG/JPEG compression.
+"""
+import os
+import queue
+import threading
+from multiprocessing import util
+
+import cv2
+
+from settings import config
+
+LEVELS = ('off', 'sampled', 'full')
+
+class DebugWriter:
+    def __init__(self, level='full', sample_every=0, low_confidence=True, scale=1.0,
+                 image_format='png', jpeg_quality=85, queue_size=16):
+        if level not in LEVELS:
+            raise ValueError(f"Unknown debug level: {level} (expected one of {', '.join(LEVELS)})")
+        self.level = level
+        self.sample_every = sample_every
+        self.low_confidence = low_confidence
+        self.scale = scale
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            level=config.get('debug', 'level', fallback='full'),
+            sample_every=config.getint('debug', 'sample_every', fallback=0),
+            low_confidence=config.getboolean('debug', 'low_confidence', fallback=True),
+            scale=config.getfloat('debug', 'scale', fallback=1.0),
+            image_format=config.get('debug', 'format', fallback='png'),
+            jpeg_quality=config.getint('debug', 'jpeg_quality', fallback=85),
+            queue_size=config.getint('debug', 'queue_size', fallback=16)
+        )
+
+    @property
+    def enabled(self):
+        return self.level != 'off'
+
+    def wants(self, page_index, low_confidence=False):
+        """Whether the page_index-th page (0-based) of the batch should get debug images."""
+        if self.level == 'full':
+            return True
+        if self.level == 'off':
+            return False
+        if self.sample_every > 0 and page_index % self.sample_every == 0:
+            return True
+        return self.low_confidence and low_confidence
+
+    def path(self, path):
+        """The path an image is actually written to, with the configured extension."""
+        root, _ = os.path.splitext(path)
+        return f"{root}.{'jpg' if self.image_format in ('jpg', 'jpeg') else 'png'}"
+
+    def write(self, path, image, scaled=False):
+        """Queue an image for writing; the writer thread downscales it first unless already scaled."""
+        self._start()
+        # Blocks when the queue is full, which bounds the memory held by pending images
+        self.queue.put((self.path(path), image, scaled))
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='debug-writer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, image, scaled = item
+            try:
+                if not scaled and self.scale < 1:
+                    image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+                params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality] if path.endswith('.jpg') else []
+                ok, encoded = cv2.imencode(os.path.splitext(path)[1], image, params)
+                if ok:
+                    encoded.tofile(path)
+                else:
+                    print(f"Error: Failed to encode debug image: {path}")
+            except Exception as e:
+                # Keep draining the queue, or write() and close() would block forever
+                print(f"Error: Failed to write debug image {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Wait for all queued images to be written and stop the writer thread."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+# One writer per process: a forked worker gets neither its parent's writer thread nor its finalizer
+writers = {}
+
+def get_debug_writer():
+    """The per-process debug writer; pending images are flushed when the process exits."""
+    pid = os.getpid()
+    if pid not in writers:
+        writers[pid] = DebugWriter.from_config(config)
+        util.Finalize(writers[pid], writers[pid].close, exitpriority=10)
+    return writers[pid]
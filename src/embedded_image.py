@@ -0,0 +1,171 @@
+"""Fast ingest for scanned PDFs: crop the page's embedded image instead of rendering the page.
+
+A scanned page is usually a single image (JPEG, CCITT, JBIG2, ...) placed
+over the whole page. For such pages poppler's pdfimages writes out that image
+(JPEGs as stored, other codecs decoded to PBM/PGM/PPM) and only the crop
+region is read at the render resolution: PNM rows are read through a memory
+map, and JPEGs are decoded in grayscale at the smallest DCT scale (1/2, 1/4,
+1/8) that still covers the render resolution. Pages with several images,
+masks, a rotation or an image not covering the page are left to rendering.
+"""
+import math
+import os
+import re
+import subprocess
+from collections import defaultdict, namedtuple
+
+import cv2
+import numpy as np
+from pdf2image import pdfinfo_from_path
+from PIL import Image
+
+# One image covering a whole page: its pixel size, encoding and the page's size when rendered
+PageScan = namedtuple('PageScan', ['page', 'width', 'height', 'encoding', 'render_size'])
+
+# How far the placed image may be from the page size (the listed ppi is rounded)
+SIZE_TOLERANCE = 0.02
+
+def list_images(pdf_path, first, last):
+    """The images `pdfimages -list` reports for a page range, or None if pdfimages is unavailable."""
+    try:
+        result = subprocess.run(['pdfimages', '-list', '-f', str(first), '-l', str(last), pdf_path],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    images = []
+    # Columns: page num type width height color comp bpc enc interp object ID x-ppi y-ppi size ratio
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) < 14 or not fields[0].isdigit():
+            continue
+        images.append({
+            'page': int(fields[0]), 'type': fields[2], 'width': int(fields[3]), 'height': int(fields[4]),
+            'components': int(fields[6]), 'bits': int(fields[7]), 'encoding': fields[8],
+            'x_ppi': float(fields[12]), 'y_ppi': float(fields[13])
+        })
+    return images
+
+def page_geometry(pdf_path, first, last):
+    """{page: (width, height) in points, rotation} from pdfinfo."""
+    info = pdfinfo_from_path(pdf_path, first_page=first, last_page=last)
+    sizes, rotations = {}, {}
+    for key, value in info.items():
+        # pdfinfo numbers the page lines only when asked for more than one page
+        match = re.fullmatch(r'Page(?:\s+(\d+))? (size|rot)', key)
+        if match is None:
+            continue
+        page = int(match.group(1) or first)
+        if match.group(2) == 'size':
+            width, height = re.match(r'([\d.]+) x ([\d.]+)', value).groups()
+            sizes[page] = (float(width), float(height))
+        else:
+            rotations[page] = int(float(value))
+    return {page: (size, rotations.get(page, 0)) for page, size in sizes.items()}
+
+def find_page_scans(pdf_path, first, last, dpi):
+    """{page: PageScan} for the pages in the range that are a single full-page image."""
+    images = list_images(pdf_path, first, last)
+    if not images:
+        return {}
+    page_images = defaultdict(list)
+    for image in images:
+        page_images[image['page']].append(image)
+
+    scans = {}
+    for page, (size, rotation) in page_geometry(pdf_path, first, last).items():
+        if rotation % 360 or len(page_images[page]) != 1:
+            continue
+        image = page_images[page][0]
+        if image['type'] != 'image' or image['components'] not in (1, 3) or image['bits'] not in (1, 8):
+            continue
+        if image['x_ppi'] <= 0 or image['y_ppi'] <= 0:
+            continue
+        placed = (image['width'] * 72 / image['x_ppi'], image['height'] * 72 / image['y_ppi'])
+        if any(abs(p - s) > SIZE_TOLERANCE * s for p, s in zip(placed, size)):
+            continue
+        # Same page size in pixels as pdftoppm renders at this dpi
+        render_size = tuple(math.ceil(s * dpi / 72) for s in size)
+        scans[page] = PageScan(page, image['width'], image['height'], image['encoding'], render_size)
+    return scans
+
+def extract_image(pdf_path, page, directory):
+    """Write the page's image into directory and return its path."""
+    subprocess.run(['pdfimages', '-j', '-f', str(page), '-l', str(page), pdf_path, os.path.join(directory, 'scan')],
+                   capture_output=True, check=True)
+    return os.path.join(directory, sorted(os.listdir(directory))[0])
+
+def pnm_header(f):
+    """Magic, width, height, maxval and data offset of a binary PBM/PGM/PPM file."""
+    magic = f.read(2)
+    values = []
+    needed = 2 if magic == b'P4' else 3
+    token = b''
+    while len(values) < needed:
+        char = f.read(1)
+        if char == b'#':
+            f.readline()
+        elif char.isspace() or not char:
+            if token:
+                values.append(int(token))
+                token = b''
+            if not char:
+                break
+        else:
+            token += char
+    # A single whitespace character separates the header from the raster
+    width, height = values[:2]
+    return magic, width, height, values[2] if needed == 3 else 1, f.tell()
+
+def read_pnm_region(path, box):
+    """Grayscale pixels of box (left, top, right, bottom) read from a PNM file, touching only those rows."""
+    with open(path, 'rb') as f:
+        magic, width, height, maxval, offset = pnm_header(f)
+    left, top, right, bottom = box
+    data = np.memmap(path, dtype=np.uint8, mode='r', offset=offset)
+    if magic == b'P4':
+        row_bytes = (width + 7) // 8
+        rows = data[:height * row_bytes].reshape(height, row_bytes)[top:bottom, left // 8:(right + 7) // 8]
+        bits = np.unpackbits(rows, axis=1)[:, left % 8:left % 8 + right - left]
+        # PBM 1 is black
+        return (1 - bits) * np.uint8(255)
+    if magic not in (b'P5', b'P6') or maxval > 255:
+        raise ValueError(f"Unsupported PNM file {path}")
+    channels = 3 if magic == b'P6' else 1
+    region = np.array(data[:height * width * channels].reshape(height, width, channels)[top:bottom, left:right])
+    region = cv2.cvtColor(region, cv2.COLOR_RGB2GRAY) if channels == 3 else region[:, :, 0]
+    if maxval != 255:
+        region = (region.astype(np.uint16) * 255 // maxval).astype(np.uint8)
+    return region
+
+def source_box(box, scale_x, scale_y, width, height):
+    """A render-resolution box mapped onto an image scaled by scale_x, scale_y, clipped to the image."""
+    left, top, right, bottom = box
+    return (min(int(left * scale_x), width - 1), min(int(top * scale_y), height - 1),
+            min(max(math.ceil(right * scale_x), 1), width), min(max(math.ceil(bottom * scale_y), 1), height))
+
+def resize_to(region, size):
+    if region.shape[1] == size[0] and region.shape[0] == size[1]:
+        return region
+    shrinking = region.shape[1] > size[0]
+    return cv2.resize(region, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+def read_region(path, scan, box):
+    """The render-resolution box of the page, as a grayscale array, read from its extracted image."""
+    render_width, render_height = scan.render_size
+    size = (box[2] - box[0], box[3] - box[1])
+    if path.endswith(('.pbm', '.pgm', '.ppm')):
+        region_box = source_box(box, scan.width / render_width, scan.height / render_height, scan.width, scan.height)
+        return resize_to(read_pnm_region(path, region_box), size)
+
+    with Image.open(path) as image:
+        # JPEGs decode at a reduced DCT scale when that still covers the render size (no-op for other formats)
+        image.draft('L', scan.render_size)
+        region_box = source_box(box, image.width / render_width, image.height / render_height, image.width, image.height)
+        region = np.asarray(image.crop(region_box).convert('L'))
+    return resize_to(region, size)
+
+def read_page(path, scan):
+    """The whole page at render resolution, as a PIL image (for the crop debug image)."""
+    with Image.open(path) as image:
+        image.draft('L', scan.render_size)
+        return image.convert('L').resize(scan.render_size)
@@ -0,0 +1,43 @@
+"""Reference layout of the printed form, shared by every page of a batch.
+
+In template mode the grade bands are detected once, on a blank form or on
+the first page, and every page is registered to that reference instead of
+having its own bands detected. The template keeps the layout of the aligned
+reference, its ink row and column profiles (what pages are registered
+against), and the key of the reference and parameters it was built from.
+It is saved as a single .npz file so worker processes can load it on their own.
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+
+class FormTemplate:
+    def __init__(self, layout, rows, columns, key=None):
+        self.layout = layout
+        self.rows = rows
+        self.columns = columns
+        self.key = key
+
+    def save(self, path):
+        """Write the template atomically, so readers never see a partial file."""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, layout=json.dumps(self.layout), rows=self.rows,
+                         columns=self.columns, key=self.key or '')
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """The template stored at path, or None if there is none."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(json.loads(str(data['layout'])), data['rows'], data['columns'], str(data['key']) or None)
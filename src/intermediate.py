@@ -0,0 +1,50 @@
+"""Reading and writing the pages passed between stages (data/cropped, data/aligned).
+
+With [pipeline] intermediate_format = png every page is its own PNG file;
+with shards the directory holds a ShardStore and pages are read zero-copy
+from memory-mapped shards. Stages address pages by directory and file name
+either way.
+"""
+import os
+from multiprocessing import util
+
+import cv2
+
+from settings import config
+from shard_store import ShardStore
+
+intermediate_format = config.get('pipeline', 'intermediate_format', fallback='png')
+shard_bytes = int(config.getfloat('pipeline', 'shard_size_mb', fallback=256) * 2**20)
+
+# Open stores by directory, per process: connections and shard files are not shared across a fork
+stores = {}
+
+def get_store(directory):
+    key = (os.getpid(), directory)
+    if key not in stores:
+        stores[key] = ShardStore(directory, shard_bytes)
+        util.Finalize(stores[key], stores[key].close, exitpriority=5)
+    return stores[key]
+
+def prepare_output(directory):
+    """Create a stage's output directory; a shard store is emptied so the stage writes it afresh."""
+    os.makedirs(directory, exist_ok=True)
+    if intermediate_format == 'shards':
+        get_store(directory).clear()
+
+def list_pages(directory):
+    if intermediate_format == 'shards':
+        return get_store(directory).pages()
+    return sorted(f for f in os.listdir(directory) if f.endswith('.png'))
+
+def read_page(path):
+    """The grayscale page stored at path, or None if it cannot be read."""
+    if intermediate_format == 'shards':
+        return get_store(os.path.dirname(path)).get(os.path.basename(path))
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+def write_page(path, image):
+    if intermediate_format == 'shards':
+        get_store(os.path.dirname(path)).put(os.path.basename(path), image)
+    else:
+        cv2.imwrite(path, image)
@@ -0,0 +1,290 @@
+"""Hot-path instrumentation: per-page phase spans, run histograms and a profiling hook.
+
+Stage code wraps its phases in span('deskew') etc. Spans recorded while a
+page(name) block is open belong to that page; spans recorded before it (the
+render and crop work that produced the page) are attached to the next page
+opened on the same thread. In a run, RunMetrics collects the page traces,
+streams them to a Chrome trace-event JSON file and writes Prometheus
+histograms to a textfile at the end.
+
+Everything is a no-op unless [metrics] enabled is set, apart from the
+cProfile hook for [metrics] profile_page and the peak RSS sampling the
+memory scheduler turns on in its workers (track_peak_rss).
+"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+from settings import config, project_root
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+enabled = config.getboolean('metrics', 'enabled', fallback=False)
+metrics_directory = os.path.join(project_root, config.get('metrics', 'dir', fallback='data/metrics'))
+profile_page = config.get('metrics', 'profile_page', fallback='')
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+process = psutil.Process()
+state = threading.local()
+# Spans outside a page are only kept once a run has started, so the stage
+# scripts, which never open pages, do not accumulate them
+collecting = False
+# Profiler of the profile_page page, kept so work resumed on its behalf after it closes is profiled too
+profilers = {}
+# Set in memory scheduler workers: spans then sample the RSS even when metrics are disabled
+track_peak_rss = False
+
+def current_process():
+    # A forked worker inherits its parent's Process object
+    global process
+    if process.pid != os.getpid():
+        process = psutil.Process()
+    return process
+
+def rss():
+    return current_process().memory_info().rss
+
+def private_memory():
+    """Memory only this process holds (USS), e.g. what a forked worker adds on top of its parent."""
+    return current_process().memory_full_info().uss
+
+def high_water_rss():
+    """Largest RSS the process ever had, or 0 where the OS does not report it."""
+    if resource is None:
+        return 0
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return value if sys.platform == 'darwin' else value * 1024
+
+def note_rss(value):
+    state.peak_rss = max(getattr(state, 'peak_rss', 0), value)
+
+def take_peak_rss():
+    """Largest RSS since the last call: sampled at this thread's span ends, or the process's
+    high-water mark if that rose in between (catching peaks inside a span)."""
+    peak = max(getattr(state, 'peak_rss', 0), rss())
+    high_water = high_water_rss()
+    if high_water > getattr(state, 'high_water', 0):
+        peak = max(peak, high_water)
+    state.peak_rss = 0
+    state.high_water = high_water
+    return peak
+
+def start_run():
+    global collecting
+    collecting = True
+
+@contextmanager
+def span(phase):
+    """Time one phase and record the RSS at its end."""
+    if not enabled:
+        if not track_peak_rss:
+            yield
+            return
+        try:
+            yield
+        finally:
+            note_rss(rss())
+        return
+    wall = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {'phase': phase, 'start': wall, 'duration': time.perf_counter() - start, 'rss': rss()}
+        if track_peak_rss:
+            note_rss(record['rss'])
+        page_trace = getattr(state, 'page', None)
+        if page_trace is not None:
+            page_trace['spans'].append(record)
+        elif collecting:
+            state.pending = getattr(state, 'pending', [])
+            state.pending.append(record)
+
+def save_profile(name, profiler):
+    """Write the profile of a page so far; returns its path."""
+    os.makedirs(metrics_directory, exist_ok=True)
+    profile_path = os.path.join(metrics_directory, f"profile_{os.path.splitext(name)[0]}.prof")
+    profiler.dump_stats(profile_path)
+    return profile_path
+
+@contextmanager
+def page(name):
+    """Collect the spans of one page; yields its trace dict (None when disabled).
+
+    With metrics disabled, the page named by profile_page still gets a trace
+    holding just its name, so resume() can profile it.
+    """
+    profiler = None
+    if profile_page and name == profile_page:
+        profiler = profilers.setdefault(name, cProfile.Profile())
+        profiler.enable()
+
+    page_trace = {'page': name} if profiler is not None else None
+    if enabled:
+        page_trace = {'page': name, 'pid': os.getpid(), 'start': time.time(), 'spans': getattr(state, 'pending', [])}
+        state.pending = []
+        state.page = page_trace
+        start = time.perf_counter()
+    try:
+        yield page_trace
+    finally:
+        if enabled:
+            page_trace['duration'] = time.perf_counter() - start
+            page_trace['rss'] = rss()
+            state.page = None
+        if profiler is not None:
+            profiler.disable()
+            print(f"Profile saved: {save_profile(name, profiler)}")
+
+@contextmanager
+def resume(page_trace):
+    """Reopen a closed page's trace, for work done on its behalf after it (batched and pipelined stages).
+
+    The profile_page page's profiler is resumed as well, and its saved
+    profile updated afterwards.
+    """
+    if page_trace is None:
+        yield
+        return
+    profiler = profilers.get(page_trace['page'])
+    if profiler is not None:
+        profiler.enable()
+    if enabled:
+        state.page = page_trace
+        start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if enabled:
+            page_trace['duration'] += time.perf_counter() - start
+            page_trace['rss'] = rss()
+            state.page = None
+        if profiler is not None:
+            profiler.disable()
+            save_profile(page_trace['page'], profiler)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        target = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= target:
+                return bound
+        return float('inf')
+
+def histogram_lines(name, help_text, histograms):
+    """Prometheus text exposition of (labels, Histogram) pairs under one metric name."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, hist in histograms:
+        label_prefix = f"{labels}," if labels else ''
+        for bound, count in zip(hist.buckets, hist.counts):
+            lines.append(f'{name}_bucket{{{label_prefix}le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{label_prefix}le="+Inf"}} {hist.count}')
+        suffix = f"{{{labels}}}" if labels else ''
+        lines.append(f"{name}_sum{suffix} {hist.sum}")
+        lines.append(f"{name}_count{suffix} {hist.count}")
+    return lines
+
+def write_textfile(path, lines):
+    # Write then rename so a textfile collector never reads a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+class RunMetrics:
+    """Run-level collector living in the process that merges the page results."""
+
+    def __init__(self, directory=metrics_directory, slowest=5):
+        os.makedirs(directory, exist_ok=True)
+        self.trace_path = os.path.join(directory, 'trace.json')
+        self.textfile_path = os.path.join(directory, 'pipeline.prom')
+        self.phases = {}
+        self.pages = Histogram()
+        self.peak_rss = rss()
+        self.slowest = []
+        self.slowest_count = slowest
+        self.start = time.perf_counter()
+        self.trace = open(self.trace_path, 'w')
+        self.trace.write('{"traceEvents": [\n')
+        self.first_event = True
+
+    def _event(self, event):
+        self.trace.write(('' if self.first_event else ',\n') + json.dumps(event))
+        self.first_event = False
+
+    def add_page(self, page_trace):
+        if page_trace is None:
+            return
+        self.pages.observe(page_trace['duration'])
+        self.peak_rss = max(self.peak_rss, page_trace['rss'])
+        self.slowest = sorted(self.slowest + [(page_trace['duration'], page_trace['page'])], reverse=True)[:self.slowest_count]
+        self._event({
+            'name': page_trace['page'], 'cat': 'page', 'ph': 'X', 'pid': page_trace['pid'], 'tid': 0,
+            'ts': page_trace['start'] * 1e6, 'dur': page_trace['duration'] * 1e6
+        })
+        for record in page_trace['spans']:
+            self.phases.setdefault(record['phase'], Histogram()).observe(record['duration'])
+            self.peak_rss = max(self.peak_rss, record['rss'])
+            self._event({
+                'name': record['phase'], 'cat': 'phase', 'ph': 'X', 'pid': page_trace['pid'], 'tid': 1,
+                'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6,
+                'args': {'page': page_trace['page'], 'rss_mb': round(record['rss'] / 2**20, 1)}
+            })
+
+    def close(self):
+        self.trace.write('\n]}\n')
+        self.trace.close()
+        self.write_textfile(time.perf_counter() - self.start)
+        self.print_summary()
+
+    def write_textfile(self, run_seconds):
+        lines = histogram_lines('ocr_pipeline_phase_seconds', 'Time spent per page in each pipeline phase.',
+                                [(f'phase="{phase}"', hist) for phase, hist in sorted(self.phases.items())])
+        lines += histogram_lines('ocr_pipeline_page_seconds', 'Total processing time per page.', [('', self.pages)])
+        lines += [
+            '# HELP ocr_pipeline_pages_total Pages processed in the run.',
+            '# TYPE ocr_pipeline_pages_total counter',
+            f'ocr_pipeline_pages_total {self.pages.count}',
+            '# HELP ocr_pipeline_run_seconds Wall time of the run.',
+            '# TYPE ocr_pipeline_run_seconds gauge',
+            f'ocr_pipeline_run_seconds {run_seconds}',
+            '# HELP ocr_pipeline_peak_rss_bytes Largest RSS seen by any span.',
+            '# TYPE ocr_pipeline_peak_rss_bytes gauge',
+            f'ocr_pipeline_peak_rss_bytes {self.peak_rss}'
+        ]
+        write_textfile(self.textfile_path, lines)
+
+    def print_summary(self):
+        print(f"Metrics: {self.pages.count} pages, peak RSS {self.peak_rss / 2**20:.0f} MB")
+        for phase, hist in sorted(self.phases.items(), key=lambda item: -item[1].sum):
+            print(f"  {phase:10s} mean {hist.sum / hist.count * 1000:8.2f} ms  p95 <= {hist.quantile(0.95) * 1000:g} ms")
+        if self.slowest:
+            print("  Slowest pages: " + ', '.join(f"{name} ({seconds * 1000:.0f} ms)" for seconds, name in self.slowest))
+        print(f"Trace saved to: {self.trace_path}")
+        print(f"Prometheus metrics saved to: {self.textfile_path}")
@@ -0,0 +1,134 @@
+"""Content-addressed, size-capped cache of per-stage page results.
+
+Each entry is keyed by a hash of the stage's input (page bytes, or the PDF
+bytes for the crop stage) and the config parameters that stage reads, so a
+changed threshold only invalidates the stages that use it. Entries are
+compressed pickle files (pages are mostly blank paper, so they shrink many
+times over). Once the cache grows past its size cap, least recently used
+entries are evicted down to a low-water mark.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+# Bump when a stage's algorithm or the entry format changes so old entries stop matching
+CACHE_VERSION = 4
+COMPRESSION_LEVEL = 1
+# Eviction trims the cache to this fraction of its cap, so it runs once per many puts rather than on each
+LOW_WATER = 0.8
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def array_digest(array):
+    digest = hashlib.sha256()
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(memoryview(array).cast('B') if array.flags['C_CONTIGUOUS'] else array.tobytes())
+    return digest.hexdigest()
+
+def stage_key(stage, input_digest, params):
+    """Cache key for a stage given the digest of its input and the parameters it depends on."""
+    payload = json.dumps([CACHE_VERSION, stage, input_digest, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class PageCache:
+    def __init__(self, directory, max_bytes, enabled=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled and max_bytes > 0
+        # Size of every entry, least recently used first; read from disk on first use
+        self.index = None
+        self.size = 0
+        # Guards the index when several threads of a process share the cache
+        self.lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config, project_root):
+        return cls(
+            os.path.join(project_root, config.get('cache', 'dir', fallback='data/cache')),
+            int(config.getfloat('cache', 'max_size_mb', fallback=2048) * 1024 * 1024),
+            config.getboolean('cache', 'enabled', fallback=False)
+        )
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.pkl'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _load_index(self):
+        """Read the entries on disk, ordered by last use (their modification time)."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.index = OrderedDict((path, size) for path, _, size in entries)
+        self.size = sum(self.index.values())
+
+    def contains(self, key):
+        return self.enabled and os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Return the cached value or None; a hit marks the entry as recently used."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, zlib.error):
+            return None
+        with self.lock:
+            if self.index is not None and path in self.index:
+                self.index.move_to_end(path)
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename so concurrent workers never read a partial entry
+        data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+            else:
+                self.size += len(data) - self.index.pop(path, 0)
+                self.index[path] = len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is down to LOW_WATER of its cap."""
+        # Read the directory again: worker processes sharing the cache add entries this index has not seen
+        self._load_index()
+        while self.index and self.size > self.max_bytes * LOW_WATER:
+            path, size = self.index.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,36 @@
+"""Page representations carried through the pipeline.
+
+Pages are single-channel 8-bit grayscale from rendering onwards; colour is
+only produced for debug overlays. For ink counting a page can further be
+binarized and bit-packed, eight pixels per byte along each row.
+"""
+import cv2
+import numpy as np
+
+def to_gray(image):
+    """The page as a single-channel array (BGR input, e.g. older PNGs, is converted)."""
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def to_bgr(image, scale=1.0):
+    """A colour copy of the page to draw a debug overlay on, downscaled by scale (< 1) before converting."""
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if image.ndim == 3:
+            return image
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image.copy()
+
+def pack_ink(gray, threshold):
+    """Binarize (pixels darker than threshold are ink) and pack the bits along rows.
+
+    Works on one page or a stack of pages; the result has ceil(width / 8)
+    bytes per row.
+    """
+    return np.packbits(gray < threshold, axis=-1)
+
+def unpack_ink(packed, width):
+    """Ink bits (1 = ink) back as a uint8 array of the given width."""
+    return np.unpackbits(packed, axis=-1, count=width)
@@ -0,0 +1,111 @@
+"""Process-pool and thread pipeline helpers shared by the pipeline stages."""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+def worker_count(workers):
+    """Resolve the configured worker count; 0 or less means one worker per CPU."""
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+def batched(items, size):
+    """Split an iterable into lists of at most size items, lazily."""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def map_ordered(func, tasks, workers=1, chunksize=1, executor=None):
+    """Apply func to every task, yielding results in task order.
+
+    With a single worker everything runs in the calling process; otherwise the
+    tasks are fanned out to a process pool. func and the tasks must be picklable.
+    A long-lived executor can be passed in to reuse its (already warm) workers.
+    """
+    if executor is not None:
+        yield from executor.map(func, tasks, chunksize=chunksize)
+        return
+
+    workers = worker_count(workers)
+    if workers == 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(func, tasks, chunksize=chunksize)
+
+def pipelined(items, stages, queue_size=2):
+    """Pass every item through stages, each on a thread of its own, yielding the last stage's outputs in order.
+
+    items is iterated on its own thread as well. Consecutive threads are
+    connected by queues holding at most queue_size items, so a stage that
+    gets ahead blocks until the next one catches up, and only a bounded number
+    of items is ever in flight. Work that releases the GIL (rendering,
+    OpenCV, zlib) overlaps across stages. An exception raised by any stage
+    stops the pipeline and is raised again here.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def put(sink, message):
+        while not stop.is_set():
+            try:
+                sink.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return ('stop', None)
+
+    def produce():
+        try:
+            for item in items:
+                if not put(queues[0], ('item', item)):
+                    return
+            put(queues[0], ('done', None))
+        except BaseException as error:
+            put(queues[0], ('error', error))
+
+    def run_stage(func, source, sink):
+        while True:
+            kind, payload = get(source)
+            if kind != 'item':
+                put(sink, (kind, payload))
+                return
+            try:
+                message = ('item', func(payload))
+            except BaseException as error:
+                message = ('error', error)
+            if not put(sink, message) or message[0] == 'error':
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=run_stage, args=(func, queues[i], queues[i + 1]), daemon=True)
+                for i, func in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            kind, payload = queues[-1].get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise payload
+            yield payload
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,399 @@
+"""In-process pipeline: each page goes from crop through deskew, bands and grading in memory."""
+import os
+import numpy as np
+from pdf2image import pdfinfo_from_path
+
+import cropper
+import align_questionnaire as aligner
+import embedded_image
+import vertical_scan_ocr as ocr
+from debug_writer import get_debug_writer
+from intermediate import prepare_output, write_page
+import metrics
+from parallel import batched, map_ordered, pipelined, worker_count
+from results_writer import open_results_writer
+from scheduler import MemoryScheduler
+from page_cache import PageCache, array_digest, file_digest, stage_key
+from page_image import to_gray
+
+project_root = cropper.project_root
+config = cropper.config
+
+cropped_directory = cropper.output_directory
+aligned_directory = os.path.join(project_root, config.get('aligner', 'output_dir'))
+output_directory = os.path.join(project_root, config.get('ocr', 'output_dir'))
+debug_directories = {
+    'cropper': cropper.debug_directory,
+    'aligner': os.path.join(project_root, config.get('aligner', 'debug_dir')),
+    'ocr': os.path.join(project_root, config.get('ocr', 'debug_dir'))
+}
+
+# Render, analysis and encoding of consecutive pages overlap on threads of their own (single worker only)
+pipelined_stages = config.getboolean('pipeline', 'pipelined', fallback=False)
+queue_size = config.getint('pipeline', 'queue_size', fallback=2)
+# Memory the run may use; with several workers, pages are then started only while they fit (0 = no limit)
+memory_budget = int(config.getfloat('pipeline', 'memory_budget_mb', fallback=0) * 2**20)
+
+page_cache = None
+
+def get_cache():
+    """The per-process stage cache, opened on first use (also inside workers)."""
+    global page_cache
+    if page_cache is None:
+        page_cache = PageCache.from_config(config, project_root)
+    return page_cache
+
+def ensure_directories(write_intermediate):
+    if write_intermediate:
+        prepare_output(cropped_directory)
+        prepare_output(aligned_directory)
+    # Read from the config, so the parent does not create a debug writer before forking workers
+    if config.get('debug', 'level', fallback='full') != 'off':
+        for directory in debug_directories.values():
+            os.makedirs(directory, exist_ok=True)
+
+def crop_key(pdf_digest, page_number):
+    return stage_key('crop', f"{pdf_digest}:{page_number}", cropper.stage_params())
+
+def render_crop(pdf_path, page_number, debug):
+    return cropper.crop_pdf_page(pdf_path, page_number, debug, get_debug_writer().scale)
+
+def cached_crop(pdf_path, pdf_digest, page_number, debug):
+    """Cropped page from the cache, rendering it on a miss. Cache hits have no crop debug image."""
+    key = crop_key(pdf_digest, page_number)
+    with metrics.span('cache'):
+        cropped = get_cache().get(key)
+    if cropped is not None:
+        return cropped, None
+    cropped, crop_debug = render_crop(pdf_path, page_number, debug)
+    with metrics.span('cache'):
+        get_cache().put(key, cropped)
+    return cropped, crop_debug
+
+def cached_align(cropped, template=None):
+    if not get_cache().enabled:
+        return aligner.align_image(cropped, template)
+    params = aligner.stage_params()
+    if template is not None:
+        params['template'] = template.key
+    with metrics.span('cache'):
+        key = stage_key('align', array_digest(cropped), params)
+        result = get_cache().get(key)
+    if result is None:
+        result = aligner.align_image(cropped, template)
+        with metrics.span('cache'):
+            get_cache().put(key, result)
+    return result
+
+def cached_grade(rotated, image_bands, name):
+    if not get_cache().enabled:
+        return ocr.grade_image(rotated, image_bands, name)
+    with metrics.span('cache'):
+        key = stage_key('ocr', array_digest(rotated), {**ocr.stage_params(), 'bands': image_bands})
+        result = get_cache().get(key)
+    if result is None:
+        result = ocr.grade_image(rotated, image_bands, name)
+        with metrics.span('cache'):
+            get_cache().put(key, result)
+    return result
+
+def cached_grade_batch(rotated_pages, image_bands, names):
+    """Grade aligned pages that share the same bands, together, reusing cached results page by page."""
+    cache = get_cache()
+    with metrics.span('cache'):
+        params = {**ocr.stage_params(), 'bands': image_bands}
+        keys = [stage_key('ocr', array_digest(rotated), params) if cache.enabled else None for rotated in rotated_pages]
+        results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    shapes = {rotated_pages[i].shape for i in missing}
+    if not image_bands['horizontal'] or not image_bands['vertical'] or len(shapes) > 1:
+        # Nothing to stack; grade_image reports the missing bands page by page
+        for i in missing:
+            results[i] = ocr.grade_image(rotated_pages[i], image_bands, names[i])
+    else:
+        pages = np.stack([ocr.ink_page(to_gray(rotated_pages[i])) for i in missing])
+        cells, percentages, grades = ocr.grade_batch(pages, image_bands, ocr.packed_width(rotated_pages[missing[0]].shape[1]))
+        for row, i in enumerate(missing):
+            results[i] = ocr.page_grades(cells[row], percentages[row], grades[row])
+    with metrics.span('cache'):
+        for i in missing:
+            cache.put(keys[i], results[i])
+    return results
+
+def iter_cropped(pdf_files, page_name=cropper.page_name):
+    """Yield (page index, page name, cropped page, crop debug image) for every page, numbered like the cropper.
+
+    Only pages missing from the cache are rendered, a window at a time.
+    page_name(i, j) names page j of the i-th PDF (cropper.page_name by default).
+    """
+    cache = get_cache()
+    debug_writer = get_debug_writer()
+    page_index = 0
+    for i, filename in enumerate(pdf_files, start=1):
+        pdf_path = os.path.join(cropper.input_directory, filename)
+        pdf_digest = file_digest(pdf_path)
+        page_count = pdfinfo_from_path(pdf_path)['Pages']
+        missing = [j for j in range(1, page_count + 1) if not cache.contains(crop_key(pdf_digest, j))]
+        wants_debug = lambda j, offset=page_index: debug_writer.wants(offset + j - 1)
+        rendered = cropper.iter_cropped_pages(pdf_path, cropper.rect_width, cropper.rect_height,
+                                              cropper.render_window, debug=wants_debug, page_numbers=missing,
+                                              debug_scale=debug_writer.scale)
+
+        missing = set(missing)
+        for j in range(1, page_count + 1):
+            if j in missing:
+                _, cropped, crop_debug = next(rendered)
+                with metrics.span('cache'):
+                    cache.put(crop_key(pdf_digest, j), cropped)
+            else:
+                # Falls back to rendering if the entry was evicted in the meantime
+                cropped, crop_debug = cached_crop(pdf_path, pdf_digest, j, wants_debug(j))
+            yield page_index, page_name(i, j), cropped, crop_debug
+            page_index += 1
+
+def document_tasks(pdf_path, page_names, write_intermediate, first_index=0):
+    """One picklable task per page of a PDF, so pages can be rendered inside worker processes.
+
+    page_names maps a page number to the page's name; first_index is the
+    batch position of the first page.
+    """
+    pdf_digest = file_digest(pdf_path)
+    page_count = pdfinfo_from_path(pdf_path)['Pages']
+    return [
+        (pdf_path, pdf_digest, j, first_index + j - 1, page_names(j), write_intermediate)
+        for j in range(1, page_count + 1)
+    ]
+
+def iter_page_tasks(pdf_files, write_intermediate, page_name=cropper.page_name):
+    page_index = 0
+    for i, filename in enumerate(pdf_files, start=1):
+        pdf_path = os.path.join(cropper.input_directory, filename)
+        tasks = document_tasks(pdf_path, lambda j: page_name(i, j), write_intermediate, page_index)
+        yield from tasks
+        page_index += len(tasks)
+
+def process_page_task(task):
+    pdf_path, pdf_digest, page_number, page_index, name, write_intermediate = task
+    with metrics.page(name) as trace:
+        cropped, crop_debug = cached_crop(pdf_path, pdf_digest, page_number, get_debug_writer().wants(page_index))
+        result = process_page(cropped, name, page_index, crop_debug, write_intermediate)
+    result['trace'] = trace
+    return result
+
+def process_page(cropped, name, page_index=0, crop_debug=None, write_intermediate=False):
+    """Run alignment and grading on one cropped page, reusing cached stage results.
+
+    Debug images are queued according to the debug policy, page_index being
+    the page's position in the batch. Returns a dict with the aligned page
+    name, its band entry and its grades (None when the page could not be graded).
+    """
+    rotated, layout = cached_align(cropped, aligner.get_template())
+    image_bands = aligner.band_entry(layout)
+    ink_cells, grades = cached_grade(rotated, image_bands, f"aligned_{name}")
+    return finish_page(name, page_index, cropped, crop_debug, rotated, layout, ink_cells, grades, write_intermediate)
+
+def finish_page(name, page_index, cropped, crop_debug, rotated, layout, ink_cells, grades, write_intermediate=False):
+    """Write a graded page's intermediate and debug images and build its result dict."""
+    aligned_name = f"aligned_{name}"
+    image_bands = aligner.band_entry(layout)
+    if write_intermediate:
+        with metrics.span('image_io'):
+            write_page(os.path.join(cropped_directory, name), cropped)
+            write_page(os.path.join(aligned_directory, aligned_name), rotated)
+
+    debug_writer = get_debug_writer()
+    if crop_debug is not None:
+        debug_writer.write(os.path.join(debug_directories['cropper'], f"debug_{name}"), crop_debug, scaled=True)
+    if debug_writer.wants(page_index, grades is None or ocr.is_low_confidence(grades)):
+        debug_writer.write(os.path.join(debug_directories['aligner'], f"debug_{name}"),
+                           aligner.draw_alignment_debug(rotated, layout, debug_writer.scale), scaled=True)
+        if ink_cells is not None:
+            debug_writer.write(os.path.join(debug_directories['ocr'], f"debug_{aligned_name}"),
+                               ocr.draw_ink_cells_and_bands(rotated, ink_cells, grades, image_bands['vertical'],
+                                                            debug_writer.scale), scaled=True)
+
+    records = ocr.grade_records(aligned_name, ink_cells, grades) if grades is not None else []
+    return {'name': aligned_name, 'bands': image_bands, 'grades': grades, 'records': records}
+
+def opened_pages(pages):
+    """Open each page's metrics trace as soon as it is cropped, so the render and crop spans land on it.
+
+    Must be iterated on the thread that renders the pages; the trace is
+    resumed by whichever thread works on the page next.
+    """
+    for page_index, name, cropped, crop_debug in pages:
+        with metrics.page(name) as trace:
+            pass
+        yield page_index, name, cropped, crop_debug, trace
+
+def analyse_pages(pages):
+    """Align and grade opened pages; more than one page must share the template's bands and is graded as one array."""
+    template = aligner.get_template()
+    aligned = []
+    for page_index, name, cropped, crop_debug, trace in pages:
+        with metrics.resume(trace):
+            rotated, layout = cached_align(cropped, template)
+        aligned.append((page_index, name, cropped, crop_debug, rotated, layout, trace))
+
+    if len(aligned) > 1:
+        # Grading of the whole batch is accounted to its last page
+        with metrics.resume(aligned[-1][-1]):
+            graded = cached_grade_batch([item[4] for item in aligned], aligner.band_entry(template.layout),
+                                        [f"aligned_{item[1]}" for item in aligned])
+    else:
+        graded = []
+        for page_index, name, cropped, crop_debug, rotated, layout, trace in aligned:
+            with metrics.resume(trace):
+                graded.append(cached_grade(rotated, aligner.band_entry(layout), f"aligned_{name}"))
+    return [item + grade for item, grade in zip(aligned, graded)]
+
+def finish_pages(analysed, write_intermediate=False):
+    """finish_page for every analysed page, returning the result dicts in page order."""
+    results = []
+    for page_index, name, cropped, crop_debug, rotated, layout, trace, ink_cells, grades in analysed:
+        with metrics.resume(trace):
+            result = finish_page(name, page_index, cropped, crop_debug, rotated, layout, ink_cells, grades, write_intermediate)
+        result['trace'] = trace
+        results.append(result)
+    return results
+
+def process_batch(pages, write_intermediate=False):
+    """Align pages one by one, then grade them together as one array.
+
+    pages yields (page index, page name, cropped page, crop debug image) and
+    must share the template's layout. Returns the result dicts in page order.
+    """
+    return finish_pages(analyse_pages(opened_pages(pages)), write_intermediate)
+
+def process_batch_task(tasks):
+    # Each page is rendered only when the batch gets to it, so render spans land on the right page
+    pages = (
+        (page_index, name, *cached_crop(pdf_path, pdf_digest, page_number, get_debug_writer().wants(page_index)))
+        for pdf_path, pdf_digest, page_number, page_index, name, _ in tasks
+    )
+    return process_batch(pages, tasks[0][-1])
+
+def grade_batch_size():
+    """Pages graded together: only pages registered to one template share their bands."""
+    return ocr.grade_batch_size if aligner.layout_mode == 'template' else 1
+
+def prepare_template(pdf_path):
+    """In template mode, make sure the form template is built before any page is processed.
+
+    Without a configured reference the first page of pdf_path is used.
+    """
+    if aligner.layout_mode != 'template':
+        return None
+    first_page = None
+    if not config.get('aligner', 'template_reference', fallback=''):
+        first_page, _ = cached_crop(pdf_path, file_digest(pdf_path), 1, False)
+    return aligner.prepare_template(first_page)
+
+def iter_task_results(tasks, workers=1, executor=None):
+    """Process page tasks on worker processes (or on a long-lived executor), yielding results in page order."""
+    batch_size = grade_batch_size()
+    if batch_size > 1:
+        for results in map_ordered(process_batch_task, batched(tasks, batch_size), workers, executor=executor):
+            yield from results
+    else:
+        yield from map_ordered(process_page_task, tasks, workers, executor=executor)
+
+def iter_pipelined_results(pdf_files, write_intermediate, page_name=cropper.page_name):
+    """Process every page on three threads: rendering, analysis and encoding work on consecutive pages at once.
+
+    The stages are connected by queues of queue_size batches, so rendering
+    never runs more than a few pages ahead of analysis, nor analysis ahead of
+    writing the intermediate and debug images.
+    """
+    batches = batched(opened_pages(iter_cropped(pdf_files, page_name)), grade_batch_size())
+    stages = [analyse_pages, lambda analysed: finish_pages(analysed, write_intermediate)]
+    for results in pipelined(batches, stages, queue_size):
+        yield from results
+
+def page_pixels(pdf_path):
+    """{page number: pixel count of the rendered page} for the pages whose size pdfinfo reports."""
+    page_count = pdfinfo_from_path(pdf_path)['Pages']
+    geometry = embedded_image.page_geometry(pdf_path, 1, page_count)
+    return {page: round(width * height * (cropper.dpi / 72) ** 2) for page, ((width, height), _) in geometry.items()}
+
+def iter_scheduled_results(pdf_files, write_intermediate, scheduler, page_name=cropper.page_name):
+    """Process page tasks with as many workers and pages in flight as the scheduler's memory budget allows."""
+    sizes = {}
+
+    def pixels(task):
+        pdf_path, _, page_number = task[:3]
+        if pdf_path not in sizes:
+            sizes[pdf_path] = page_pixels(pdf_path)
+        return sizes[pdf_path].get(page_number)
+
+    tasks = iter_page_tasks(pdf_files, write_intermediate, page_name)
+    batch_size = grade_batch_size()
+    if batch_size > 1:
+        batches = batched(tasks, batch_size)
+        for results in scheduler.map(process_batch_task, batches, lambda batch: [pixels(task) for task in batch]):
+            yield from results
+    else:
+        yield from scheduler.map(process_page_task, tasks, lambda task: [pixels(task)])
+
+def iter_results(pdf_files, write_intermediate, workers, scheduler=None, page_name=cropper.page_name):
+    """Process every page, yielding results in page order whatever the worker count."""
+    if scheduler is not None:
+        yield from iter_scheduled_results(pdf_files, write_intermediate, scheduler, page_name)
+    elif worker_count(workers) > 1:
+        yield from iter_task_results(iter_page_tasks(pdf_files, write_intermediate, page_name), workers)
+    elif pipelined_stages:
+        yield from iter_pipelined_results(pdf_files, write_intermediate, page_name)
+    elif grade_batch_size() > 1:
+        for pages in batched(iter_cropped(pdf_files, page_name), grade_batch_size()):
+            yield from process_batch(pages, write_intermediate)
+    else:
+        for page_index, name, cropped, crop_debug in iter_cropped(pdf_files, page_name):
+            # The render and crop spans recorded by iter_cropped attach to this page
+            with metrics.page(name) as trace:
+                result = process_page(cropped, name, page_index, crop_debug, write_intermediate)
+            result['trace'] = trace
+            yield result
+
+def memory_scheduler(workers):
+    """A MemoryScheduler when a memory budget is set and pages go to several workers, otherwise None."""
+    if memory_budget > 0 and worker_count(workers) > 1:
+        return MemoryScheduler(memory_budget, worker_count(workers))
+    return None
+
+def run(write_intermediate=False, workers=1):
+    ensure_directories(write_intermediate)
+    pdf_files = cropper.list_pdf_files(cropper.input_directory)
+    # Built in the parent so workers only ever load it
+    if pdf_files:
+        prepare_template(os.path.join(cropper.input_directory, pdf_files[0]))
+
+    scheduler = memory_scheduler(workers)
+
+    # Results are merged in the parent only, in page order, so the output
+    # matches a sequential run. Each page's bands are stored as soon as it is done.
+    page_count = 0
+    metrics.start_run()
+    run_metrics = metrics.RunMetrics() if metrics.enabled else None
+    with aligner.open_band_store() as band_store, \
+            open_results_writer(output_directory, ocr.output_format, ocr.output_batch_size) as writer:
+        for result in iter_results(pdf_files, write_intermediate, workers, scheduler):
+            band_store.put(result['name'], result['bands'])
+            writer.write_many(result['records'])
+            if run_metrics is not None:
+                run_metrics.add_page(result['trace'])
+            if result['grades'] is not None:
+                ocr.print_grades(result['name'], result['grades'])
+            page_count += 1
+        aligner.export_bands_json(band_store)
+    get_debug_writer().close()
+    if run_metrics is not None:
+        run_metrics.close()
+    print(f"Grades saved to: {writer.path}")
+    print(f"Grade bands saved to: {band_store.path}")
+    print(f"In-process pipeline completed. {len(pdf_files)} PDFs, {page_count} pages processed.")
+    if scheduler is not None:
+        scheduler.print_summary()
+    return page_count
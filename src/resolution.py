@@ -0,0 +1,37 @@
+"""Pixel sizes relative to the render resolution, and the pyramid level pages are analysed at.
+
+Sizes in config.ini (crop rectangle, cell size, band gap, ...) are in pixels
+at reference_dpi, the resolution they were tuned at, and are scaled to the
+resolution pages are rendered at ([cropper] dpi), so changing dpi keeps the
+same physical sizes. With [aligner] analysis_dpi set, deskew, margins and
+band detection run on a downscaled level of the page instead of the full
+resolution one.
+"""
+import cv2
+
+from settings import config
+
+dpi = config.getint('cropper', 'dpi', fallback=200)
+reference_dpi = config.getint('cropper', 'reference_dpi', fallback=200)
+analysis_dpi = config.getint('aligner', 'analysis_dpi', fallback=0)
+
+def pixels(value):
+    """A size in pixels at reference_dpi, in pixels at dpi."""
+    return max(int(round(value * dpi / reference_dpi)), 1)
+
+def pyramid_factor():
+    """Downscale factor (a power of two) of the smallest pyramid level still at or above analysis_dpi."""
+    factor = 1
+    if analysis_dpi > 0:
+        while dpi / (factor * 2) >= analysis_dpi:
+            factor *= 2
+    return factor
+
+def pyramid_level(gray, factor):
+    """The page downscaled by factor, each pixel the mean of a factor x factor block."""
+    if factor == 1:
+        return gray
+    height, width = gray.shape[:2]
+    # Trailing rows/columns that do not fill a block are dropped, keeping the reduction an exact box filter
+    height, width = height // factor, width // factor
+    return cv2.resize(gray[:height * factor, :width * factor], (width, height), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,109 @@
+"""Streaming writers for per-question grade records.
+
+Records are buffered and flushed to disk every batch_size records, so memory
+stays constant whatever the batch size. CSV and JSONL need nothing beyond the
+standard library; the columnar Parquet format needs pyarrow.
+"""
+import csv
+import json
+import os
+
+FIELDS = ['page', 'question_number', 'section', 'question', 'grade', 'grade_percentage', 'cell_score']
+
+EXTENSIONS = {'csv': 'csv', 'jsonl': 'jsonl', 'parquet': 'parquet'}
+
+class ResultsWriter:
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = max(batch_size, 1)
+        self.buffer = []
+        self.count = 0
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.buffer:
+            self._write_batch(self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CsvResultsWriter(ResultsWriter):
+    def __init__(self, path, batch_size=500):
+        super().__init__(path, batch_size)
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+        self.writer.writeheader()
+
+    def _write_batch(self, records):
+        self.writer.writerows(records)
+        self.file.flush()
+
+    def _close(self):
+        self.file.close()
+
+class JsonlResultsWriter(ResultsWriter):
+    def __init__(self, path, batch_size=500):
+        super().__init__(path, batch_size)
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def _write_batch(self, records):
+        self.file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        self.file.flush()
+
+    def _close(self):
+        self.file.close()
+
+class ParquetResultsWriter(ResultsWriter):
+    """Writes each flushed batch as one Parquet row group."""
+
+    def __init__(self, path, batch_size=500):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("The parquet output format requires pyarrow (pip install pyarrow)") from e
+        super().__init__(path, batch_size)
+        self.pa = pa
+        self.schema = pa.schema([
+            ('page', pa.string()),
+            ('question_number', pa.int32()),
+            ('section', pa.string()),
+            ('question', pa.string()),
+            ('grade', pa.int32()),
+            ('grade_percentage', pa.float64()),
+            ('cell_score', pa.float64())
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def _write_batch(self, records):
+        columns = {field: [record[field] for record in records] for field in FIELDS}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def _close(self):
+        self.writer.close()
+
+WRITERS = {'csv': CsvResultsWriter, 'jsonl': JsonlResultsWriter, 'parquet': ParquetResultsWriter}
+
+def open_results_writer(output_directory, output_format='csv', batch_size=500, name='grades'):
+    if output_format not in WRITERS:
+        raise ValueError(f"Unknown output format: {output_format} (expected one of {', '.join(WRITERS)})")
+    os.makedirs(output_directory, exist_ok=True)
+    path = os.path.join(output_directory, f"{name}.{EXTENSIONS[output_format]}")
+    return WRITERS[output_format](path, batch_size)
@@ -17,20 +17,35 @@ def run_step(script_name):
     print(f"Running {script_name}...")
     try:
         script_path = os.path.join(script_dir, script_name)
-        result = subprocess.run(['python', script_path], check=True, text=True, capture_output=True)
-        print(result.stdout)
-        if result.stderr:
-            print("Errors:")
-            print(result.stderr)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running {script_name}:")
-        print(e.stdout)
-        print("Error output:")
-        print(e.stderr)
+        # Output is streamed through rather than buffered, so memory stays flat on large batches
+        subprocess.run(['python', script_path], check=True)
+    except subprocess.CalledProcessError:
+        print(f"Error running {script_name}.")
         raise
     print(f"{script_name} completed.\n")
 
 def main():
+    mode = config.get('pipeline', 'mode', fallback='inprocess')
+    if mode == 'inprocess':
+        import pipeline
+        pipeline.run(
+            write_intermediate=config.getboolean('pipeline', 'write_intermediate', fallback=False),
+            workers=config.getint('pipeline', 'workers', fallback=1)
+        )
+        print("Pipeline completed.")
+        return
+    if mode == 'service':
+        import service
+        service.main()
+        return
+    if mode == 'shard':
+        import sharding
+        sharding.run_node(
+            write_intermediate=config.getboolean('pipeline', 'write_intermediate', fallback=False),
+            workers=config.getint('pipeline', 'workers', fallback=1)
+        )
+        return
+
     pipeline_steps = config.get('pipeline', 'steps').split(',')
     
     for step in pipeline_steps:
@@ -0,0 +1,194 @@
+"""Memory-aware scheduling of page tasks on worker processes.
+
+Instead of a fixed pool, MemoryScheduler starts workers (single-process
+executors) only while the memory budget allows, and keeps as many pages in
+flight as fit. What things cost is measured, not configured: each task
+reports its worker's private memory afterwards (including what the worker
+keeps, such as caches) and how far the RSS sampled by its spans rose while
+it ran, from which a cost per rendered pixel is learned. The next page's
+cost is predicted from its pixel area (page size at the render dpi), so a
+huge or high-dpi page waits for other pages to finish, and may have idle
+workers shut down to make room. Once it is done, smaller pages fill the
+budget again.
+"""
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import psutil
+
+import metrics
+
+# Last pages whose measured cost the per-pixel estimate is taken over (the largest one wins)
+WINDOW = 16
+# A page this much larger than any measured one is not estimated from them: it runs alone until measured
+EXTRAPOLATION_LIMIT = 1.25
+
+def measured_task(args):
+    """Run func(task) in a worker; also return the worker's pid, its private memory after the task and how far the task raised its RSS."""
+    func, task = args
+    metrics.track_peak_rss = True
+    metrics.take_peak_rss()
+    start = metrics.rss()
+    result = func(task)
+    return result, os.getpid(), metrics.private_memory(), max(metrics.take_peak_rss() - start, 0)
+
+class MemoryScheduler:
+    def __init__(self, budget, max_workers):
+        self.budget = budget
+        self.max_workers = max_workers
+        self.idle = []
+        self.running = {}
+        # Private memory of each worker, as of its last task, and its process for live readings
+        self.worker_memory = {}
+        self.worker_processes = {}
+        self.pixel_costs = deque(maxlen=WINDOW)
+        self.page_costs = deque(maxlen=WINDOW)
+        self.largest_page = 0
+        # Run summary
+        self.pages = 0
+        self.in_flight_total = 0
+        self.max_in_flight = 0
+        self.max_live_workers = 0
+        self.held_back = 0
+        self.retired = 0
+
+    def live_workers(self):
+        return len(self.idle) + len(self.running)
+
+    def typical_worker_memory(self):
+        return max(self.worker_memory.values(), default=0)
+
+    def page_cost(self, pixels):
+        """Predicted memory of a page of this many rendered pixels (None if unknown).
+
+        None when no page was measured yet, or when the page is much larger
+        than every measured one: pages of a small size mostly reuse memory
+        their worker already holds, so their cost per pixel understates what
+        a far larger page allocates.
+        """
+        if pixels and self.pixel_costs:
+            if pixels > EXTRAPOLATION_LIMIT * self.largest_page:
+                return None
+            return max(self.pixel_costs) * pixels
+        return max(self.page_costs, default=None)
+
+    def task_cost(self, page_pixels):
+        costs = [self.page_cost(pixels) for pixels in page_pixels]
+        return None if None in costs else sum(costs)
+
+    def worker_footprint(self, executor, cost=0):
+        """Memory a worker holds, or will once its running task (of this cost) peaks: the larger of that
+        estimate and what the worker holds right now."""
+        estimate = self.worker_memory.get(executor, self.typical_worker_memory()) + cost
+        process = self.worker_processes.get(executor)
+        if process is None:
+            return estimate
+        try:
+            return max(estimate, process.memory_full_info().uss)
+        except psutil.Error:
+            return estimate
+
+    def committed(self):
+        """Memory the run is expected to hold: this process, every live worker and the pages being processed."""
+        workers = sum(self.worker_footprint(executor) for executor in self.idle)
+        workers += sum(self.worker_footprint(executor, cost) for executor, cost, _ in self.running.values())
+        return metrics.rss() + workers
+
+    def fits(self, cost):
+        """Whether a task of this cost can start now; with nothing running it always can."""
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_workers or cost is None:
+            # A page whose cost cannot be estimated yet runs by itself
+            return False
+        new_worker = 0 if self.idle else self.typical_worker_memory()
+        return self.committed() + new_worker + cost <= self.budget
+
+    def record(self, future):
+        executor, _, page_pixels = self.running.pop(future)
+        self.idle.append(executor)
+        _, pid, worker_memory, task_bytes = future.result()
+        self.worker_memory[executor] = worker_memory
+        if executor not in self.worker_processes:
+            self.worker_processes[executor] = psutil.Process(pid)
+        self.page_costs.append(task_bytes / len(page_pixels))
+        if all(page_pixels):
+            self.pixel_costs.append(task_bytes / sum(page_pixels))
+            self.largest_page = max(self.largest_page, *page_pixels)
+
+    def retire_idle(self):
+        """Shut down the idle worker holding the most memory (e.g. left over from a huge page)."""
+        executor = max(self.idle, key=lambda e: self.worker_memory.get(e, 0))
+        self.idle.remove(executor)
+        executor.shutdown()
+        self.worker_memory.pop(executor, None)
+        self.worker_processes.pop(executor, None)
+        self.retired += 1
+
+    def submit(self, func, task, page_pixels, cost):
+        if self.idle:
+            executor = min(self.idle, key=lambda e: self.worker_memory.get(e, 0))
+            self.idle.remove(executor)
+        else:
+            executor = ProcessPoolExecutor(max_workers=1)
+        future = executor.submit(measured_task, (func, task))
+        self.running[future] = (executor, cost or 0, page_pixels)
+        in_flight = sum(len(pixels) for _, _, pixels in self.running.values())
+        self.pages += len(page_pixels)
+        self.in_flight_total += in_flight * len(page_pixels)
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        self.max_live_workers = max(self.max_live_workers, self.live_workers())
+        return future
+
+    def wait_any(self):
+        done, _ = wait(list(self.running), return_when=FIRST_COMPLETED)
+        for future in done:
+            self.record(future)
+
+    def map(self, func, tasks, task_pixels):
+        """Apply func to every task on the workers, yielding results in task order.
+
+        task_pixels(task) gives the rendered pixel count of each page the task
+        works on (None where unknown). func and the tasks must be picklable.
+        """
+        pending = deque()
+        try:
+            for task in tasks:
+                page_pixels = task_pixels(task)
+                held_back = False
+                while not self.fits(self.task_cost(page_pixels)):
+                    if len(self.running) < self.max_workers:
+                        held_back = True
+                        # Only one idle worker is needed for this task; the others just hold memory
+                        if len(self.idle) > 1 and self.task_cost(page_pixels) is not None:
+                            self.retire_idle()
+                            continue
+                    self.wait_any()
+                    while pending and pending[0] not in self.running:
+                        yield pending.popleft().result()[0]
+                self.held_back += held_back
+                pending.append(self.submit(func, task, page_pixels, self.task_cost(page_pixels)))
+            while pending:
+                future = pending.popleft()
+                while future in self.running:
+                    self.wait_any()
+                yield future.result()[0]
+        finally:
+            self.close()
+
+    def close(self):
+        for executor in self.idle + [executor for executor, _, _ in self.running.values()]:
+            executor.shutdown(cancel_futures=True)
+        self.idle = []
+        self.running = {}
+
+    def print_summary(self):
+        if not self.pages:
+            return
+        page_mb = max(self.page_costs, default=0) / 2**20
+        worker_mb = self.typical_worker_memory() / 2**20
+        print(f"Scheduler: {self.budget / 2**20:.0f} MB budget, up to {self.max_live_workers} of {self.max_workers} workers, "
+              f"{self.in_flight_total / self.pages:.1f} pages in flight on average (at most {self.max_in_flight}), "
+              f"{self.held_back} tasks held back for memory, {self.retired} idle workers stopped")
+        print(f"  Measured up to {page_mb:.0f} MB per page and {worker_mb:.0f} MB per worker")
@@ -0,0 +1,294 @@
+"""Long-running service: grades PDFs as they arrive in the input directory.
+
+Config, libraries and worker processes are loaded once, then the input
+directory is polled for new PDFs (and, when http_port is set, PDFs can be
+POSTed to a local endpoint). Each document is queued and graded on the warm
+workers, its grades written to output_dir/<document name>.<format>, and the
+PDF moved to processed_dir (or failed_dir) so it is graded exactly once.
+Per-document queue wait, processing time and end-to-end latency are kept as
+histograms in <metrics dir>/service.prom.
+
+    python src/service.py
+"""
+import json
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cropper
+import align_questionnaire as aligner
+import vertical_scan_ocr as ocr
+from debug_writer import get_debug_writer
+import metrics
+import pipeline
+from parallel import worker_count
+from results_writer import open_results_writer
+
+project_root = pipeline.project_root
+config = pipeline.config
+
+input_directory = cropper.input_directory
+processed_directory = os.path.join(project_root, config.get('service', 'processed_dir', fallback='data/processed'))
+failed_directory = os.path.join(project_root, config.get('service', 'failed_dir', fallback='data/failed'))
+poll_interval = config.getfloat('service', 'poll_interval', fallback=2)
+http_port = config.getint('service', 'http_port', fallback=0)
+
+# Histogram bucket upper bounds for whole documents, in seconds
+DOCUMENT_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+def document_page_name(filename, page_number):
+    """Pages are named after their document, since arrival order is not a stable numbering."""
+    return f"{os.path.splitext(filename)[0]}_page_{page_number}.png"
+
+def warm_up(_):
+    """No-op task that makes the pool start every worker before the first document arrives."""
+    return os.getpid()
+
+class DocumentMetrics:
+    def __init__(self, directory=metrics.metrics_directory):
+        os.makedirs(directory, exist_ok=True)
+        self.textfile_path = os.path.join(directory, 'service.prom')
+        self.wait = metrics.Histogram(DOCUMENT_BUCKETS)
+        self.processing = metrics.Histogram(DOCUMENT_BUCKETS)
+        self.latency = metrics.Histogram(DOCUMENT_BUCKETS)
+        self.documents = {'done': 0, 'failed': 0}
+        self.pages = 0
+        self.start = time.time()
+
+    def add_document(self, wait, processing, pages, ok):
+        self.wait.observe(wait)
+        self.processing.observe(processing)
+        self.latency.observe(wait + processing)
+        self.documents['done' if ok else 'failed'] += 1
+        self.pages += pages
+        self.write_textfile()
+
+    def write_textfile(self):
+        lines = metrics.histogram_lines('ocr_service_document_wait_seconds', 'Time documents spent queued.', [('', self.wait)])
+        lines += metrics.histogram_lines('ocr_service_document_processing_seconds', 'Time spent grading each document.', [('', self.processing)])
+        lines += metrics.histogram_lines('ocr_service_document_latency_seconds', 'Time from arrival to graded, per document.', [('', self.latency)])
+        lines += ['# HELP ocr_service_documents_total Documents handled, by outcome.', '# TYPE ocr_service_documents_total counter']
+        lines += [f'ocr_service_documents_total{{status="{status}"}} {count}' for status, count in self.documents.items()]
+        lines += [
+            '# HELP ocr_service_pages_total Pages graded.',
+            '# TYPE ocr_service_pages_total counter',
+            f'ocr_service_pages_total {self.pages}'
+        ]
+        metrics.write_textfile(self.textfile_path, lines)
+
+    def status(self):
+        return {
+            'uptime_seconds': time.time() - self.start,
+            'documents': dict(self.documents),
+            'pages': self.pages,
+            'latency_p50_seconds': self.latency.quantile(0.5) if self.latency.count else None,
+            'latency_p95_seconds': self.latency.quantile(0.95) if self.latency.count else None
+        }
+
+class Service:
+    def __init__(self, workers=1, write_intermediate=False):
+        self.workers = worker_count(workers)
+        self.write_intermediate = write_intermediate
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Files seen once and waiting to be unchanged on the next scan, and files already queued
+        self.settling = {}
+        self.queued = set()
+        self.stopping = threading.Event()
+        self.page_index = 0
+        self.template_ready = False
+        self.executor = None
+        self.band_store = None
+        self.document_metrics = DocumentMetrics()
+
+    def claim(self, path):
+        """Mark a path as queued; False if it already is (waiting, being graded or being uploaded)."""
+        with self.lock:
+            if path in self.queued:
+                return False
+            self.queued.add(path)
+            self.settling.pop(path, None)
+            return True
+
+    def release(self, path):
+        with self.lock:
+            self.queued.discard(path)
+
+    def enqueue(self, path, received=None, claimed=False):
+        if claimed or self.claim(path):
+            self.queue.put((path, received or time.time()))
+
+    def scan(self):
+        """Queue the PDFs whose size and modification time did not change since the previous scan."""
+        present = set()
+        for filename in cropper.list_pdf_files(input_directory):
+            path = os.path.join(input_directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            present.add(path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            with self.lock:
+                if path in self.queued:
+                    continue
+                settled = self.settling.get(path) == signature
+                self.settling[path] = signature
+            if settled:
+                self.enqueue(path)
+        with self.lock:
+            for path in set(self.settling) - present:
+                del self.settling[path]
+
+    def watch(self):
+        self.scan()
+        while not self.stopping.wait(poll_interval):
+            self.scan()
+
+    def process(self, path):
+        """Grade one document; returns its page count."""
+        filename = os.path.basename(path)
+        if not self.template_ready:
+            # Built from the first document when no reference is configured, then kept for the service's lifetime
+            pipeline.prepare_template(path)
+            self.template_ready = True
+
+        tasks = pipeline.document_tasks(path, lambda j: document_page_name(filename, j), self.write_intermediate, self.page_index)
+        self.page_index += len(tasks)
+        name = os.path.splitext(filename)[0]
+        with open_results_writer(pipeline.output_directory, ocr.output_format, ocr.output_batch_size, name=name) as writer:
+            for result in pipeline.iter_task_results(tasks, self.workers, self.executor):
+                self.band_store.put(result['name'], result['bands'])
+                writer.write_many(result['records'])
+        return len(tasks)
+
+    def handle(self, path, received):
+        started = time.time()
+        pages, ok = 0, True
+        try:
+            pages = self.process(path)
+        except Exception:
+            ok = False
+            traceback.print_exc()
+        processing = time.time() - started
+
+        destination = processed_directory if ok else failed_directory
+        if os.path.exists(path):
+            shutil.move(path, os.path.join(destination, os.path.basename(path)))
+        self.release(path)
+        self.document_metrics.add_document(started - received, processing, pages, ok)
+        outcome = f"{pages} pages graded" if ok else "failed"
+        print(f"{os.path.basename(path)}: {outcome} in {processing:.2f}s (latency {time.time() - received:.2f}s)")
+
+    def stop(self, *_):
+        self.stopping.set()
+
+    def serve(self):
+        pipeline.ensure_directories(self.write_intermediate)
+        for directory in (input_directory, processed_directory, failed_directory):
+            os.makedirs(directory, exist_ok=True)
+
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            list(self.executor.map(warm_up, range(self.workers)))
+            print(f"Started {self.workers} worker processes")
+        self.band_store = aligner.open_band_store()
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        threading.Thread(target=self.watch, daemon=True).start()
+        server = None
+        if http_port:
+            server = ThreadingHTTPServer(('127.0.0.1', http_port), make_handler(self))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print(f"Accepting documents on http://127.0.0.1:{server.server_address[1]}/documents")
+        print(f"Watching {input_directory} (every {poll_interval:g}s)")
+
+        try:
+            while not self.stopping.is_set():
+                try:
+                    path, received = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self.handle(path, received)
+        finally:
+            if server is not None:
+                server.shutdown()
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.band_store.close()
+            get_debug_writer().close()
+            print(f"Service stopped. {self.document_metrics.documents['done']} documents graded.")
+
+def make_handler(service):
+    class SubmissionHandler(BaseHTTPRequestHandler):
+        """POST /documents?name=<file>.pdf with the PDF as body queues it; GET /status reports the service."""
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/status':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {**service.document_metrics.status(), 'queued': service.queue.qsize()})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/documents':
+                return self.send_json(404, {'error': 'not found'})
+            name = parse_qs(url.query).get('name', [''])[0]
+            if not name.endswith('.pdf') or os.path.basename(name) != name:
+                return self.send_json(400, {'error': 'name must be a plain file name ending in .pdf'})
+
+            received = time.time()
+            length = int(self.headers.get('Content-Length', 0))
+            path = os.path.join(input_directory, name)
+            # Claimed before writing, so a document that is queued or being graded is never overwritten
+            if not service.claim(path):
+                return self.send_json(409, {'error': f'{name} is already queued or being graded'})
+            # Written under a temporary name first so the watcher never picks up a partial file
+            tmp_path = os.path.join(input_directory, f".{name}.part")
+            try:
+                with open(tmp_path, 'wb') as f:
+                    remaining = length
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(remaining, 1 << 20))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                service.release(path)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            service.enqueue(path, received, claimed=True)
+            self.send_json(202, {'document': name, 'queued': service.queue.qsize()})
+
+        def log_message(self, *args):
+            pass
+
+    return SubmissionHandler
+
+def main():
+    service = Service(
+        workers=config.getint('pipeline', 'workers', fallback=1),
+        write_intermediate=config.getboolean('pipeline', 'write_intermediate', fallback=False)
+    )
+    service.serve()
+
+if __name__ == "__main__":
+    main()
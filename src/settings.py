@@ -0,0 +1,14 @@
+"""Project paths and config/config.ini, loaded once for the modules that share them."""
+import configparser
+import os
+
+# Get the absolute path to the script's directory
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory (project root)
+project_root = os.path.dirname(script_dir)
+# Construct the path to the config file
+config_path = os.path.join(project_root, 'config', 'config.ini')
+
+# Load configuration
+config = configparser.ConfigParser()
+config.read(config_path)
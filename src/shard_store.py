@@ -0,0 +1,123 @@
+"""Memory-mapped store for the pages passed between stages.
+
+Instead of one PNG per page, raw page arrays are appended to a few large
+shard files, and an SQLite index (in WAL mode, like the band store) records
+each page's shard, offset, shape and dtype. Reads are zero-copy: a page is
+a read-only NumPy view of the memory-mapped shard. Every writer process
+appends to shard files of its own, so worker processes never contend for
+a file; only the index is shared.
+"""
+import json
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+
+class ShardStore:
+    def __init__(self, directory, shard_bytes=256 * 2**20):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Shared by the threads of a process (e.g. a pipelined run's encode thread); the lock serialises them
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'page TEXT PRIMARY KEY, shard TEXT NOT NULL, offset INTEGER NOT NULL, '
+            'shape TEXT NOT NULL, dtype TEXT NOT NULL)'
+        )
+        self.connection.commit()
+        self.shard = None
+        self.shard_name = None
+        self.shard_size = 0
+        self.maps = {}
+
+    def _new_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='pages-', suffix='.shard')
+        self.shard = os.fdopen(fd, 'wb')
+        self.shard_name = os.path.basename(path)
+        self.shard_size = 0
+
+    def put(self, page, array):
+        """Append a page array to this process's current shard and index it."""
+        with self.lock:
+            array = np.ascontiguousarray(array)
+            if self.shard is None or (self.shard_size and self.shard_size + array.nbytes > self.shard_bytes):
+                self._new_shard()
+            offset = self.shard_size
+            self.shard.write(memoryview(array).cast('B'))
+            # The bytes must be visible to other processes before the index points at them
+            self.shard.flush()
+            self.shard_size += array.nbytes
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages (page, shard, offset, shape, dtype) VALUES (?, ?, ?, ?, ?)',
+                (page, self.shard_name, offset, json.dumps(array.shape), array.dtype.str)
+            )
+            self.connection.commit()
+
+    def _map(self, shard, needed):
+        """Memory map of a shard covering at least needed bytes (remapped as the shard grows)."""
+        mapping = self.maps.get(shard)
+        if mapping is None or len(mapping) < needed:
+            with open(os.path.join(self.directory, shard), 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = mapping
+        return mapping
+
+    def get(self, page):
+        """A read-only view of the page in the mapped shard, or None if it has not been stored."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT shard, offset, shape, dtype FROM pages WHERE page = ?', (page,)
+            ).fetchone()
+            if row is None:
+                return None
+            shard, offset, shape, dtype = row
+            shape = tuple(json.loads(shape))
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            mapping = self._map(shard, offset + count * dtype.itemsize)
+            return np.frombuffer(mapping, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def pages(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT page FROM pages ORDER BY page')]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def clear(self):
+        """Remove every page, e.g. before a stage writes its outputs afresh."""
+        with self.lock:
+            self.close_shards()
+            self.connection.execute('DELETE FROM pages')
+            self.connection.commit()
+            for name in os.listdir(self.directory):
+                if name.endswith('.shard'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def close_shards(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+        # Mappings still referenced by page views are left for the garbage collector
+        self.maps = {}
+
+    def close(self):
+        with self.lock:
+            self.close_shards()
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,184 @@
+"""Sharded batch runs: several nodes each grade a share of the input PDFs, then the shares are merged.
+
+Every node lists the same (shared) input directory and takes the PDFs whose
+content id, the SHA-256 of the file, falls in its shard, so the split does
+not depend on file names, listing order or which node starts first. For
+each of its PDFs a node writes a self-contained partial result to the
+shared directory: <content id>.json, holding every page's bands and grade
+records keyed by page number, plus a digest of the parameters (and form
+template) they were produced with. Nodes name their pages after the content
+id, so intermediate and debug images do not collide either.
+
+Merging lists the input directory like a single run would, numbers the
+pages the same way (questionnaire_<i>_page_<j>, PDFs sorted by name) and
+writes the usual grades file and band store, identical to a single-node
+run. Nodes and the merge only ever share that directory; a node that is
+run again skips the PDFs whose partial result is already there.
+
+    python src/sharding.py run --index 0 --count 3
+    python src/sharding.py merge
+"""
+import argparse
+import json
+import os
+import tempfile
+from itertools import groupby
+
+import cropper
+import align_questionnaire as aligner
+import vertical_scan_ocr as ocr
+from debug_writer import get_debug_writer
+import pipeline
+from page_cache import file_digest, stage_key
+from results_writer import open_results_writer
+
+project_root = pipeline.project_root
+config = pipeline.config
+
+shared_directory = os.path.join(project_root, config.get('sharding', 'dir', fallback='data/shards'))
+shard_count = config.getint('sharding', 'count', fallback=1)
+shard_index = config.getint('sharding', 'index', fallback=0)
+
+def content_ids(pdf_files):
+    return {filename: file_digest(os.path.join(cropper.input_directory, filename)) for filename in pdf_files}
+
+def shard_of(content_id, count):
+    return int(content_id, 16) % count
+
+def node_page_name(content_id, page_number):
+    """Pages are named after their PDF's content, which every node agrees on, rather than its batch position."""
+    return f"{content_id[:16]}_page_{page_number}.png"
+
+def partial_path(content_id):
+    return os.path.join(shared_directory, f"{content_id}.json")
+
+def run_params(template):
+    """Digest of everything the grades depend on besides the PDF itself; partial results are only merged when they agree."""
+    params = {
+        'crop': cropper.stage_params(),
+        'align': aligner.stage_params(),
+        'ocr': ocr.stage_params(),
+        'template': template.key if template is not None else None
+    }
+    return stage_key('run', '', params)
+
+def read_partial(content_id):
+    try:
+        with open(partial_path(content_id), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_partial(content_id, filename, params, results):
+    """Write a PDF's partial result atomically, so the merge never reads a half-written one."""
+    pages = []
+    for page_number, result in enumerate(results, start=1):
+        records = [{key: value for key, value in record.items() if key != 'page'} for record in result['records']]
+        pages.append({'page': page_number, 'bands': result['bands'], 'records': records})
+    partial = {'id': content_id, 'file': filename, 'params': params, 'pages': pages}
+    fd, tmp_path = tempfile.mkstemp(dir=shared_directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            # Grades may be NumPy scalars
+            json.dump(partial, f, default=lambda value: value.item())
+        os.replace(tmp_path, partial_path(content_id))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def run_node(index=shard_index, count=shard_count, write_intermediate=False, workers=1):
+    """Grade this node's share of the input PDFs, writing one partial result per PDF."""
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index {index} is outside 0..{count - 1}")
+    os.makedirs(shared_directory, exist_ok=True)
+    pipeline.ensure_directories(write_intermediate)
+    pdf_files = cropper.list_pdf_files(cropper.input_directory)
+    ids = content_ids(pdf_files)
+    # Every node builds the template from the same first PDF a single run would use
+    template = pipeline.prepare_template(os.path.join(cropper.input_directory, pdf_files[0])) if pdf_files else None
+    params = run_params(template)
+
+    todo = []
+    for filename in pdf_files:
+        content_id = ids[filename]
+        if shard_of(content_id, count) != index or any(ids[other] == content_id for other in todo):
+            continue
+        partial = read_partial(content_id)
+        if partial is None or partial['params'] != params:
+            todo.append(filename)
+    print(f"Shard {index} of {count}: {len(todo)} of {len(pdf_files)} PDFs to grade")
+
+    page_files = {}
+    def page_name(i, j):
+        name = node_page_name(ids[todo[i - 1]], j)
+        page_files[f"aligned_{name}"] = todo[i - 1]
+        return name
+
+    scheduler = pipeline.memory_scheduler(workers)
+    results = pipeline.iter_results(todo, write_intermediate, workers, scheduler, page_name)
+    page_count = 0
+    graded = set()
+    for filename, pdf_results in groupby(results, key=lambda result: page_files[result['name']]):
+        pdf_results = list(pdf_results)
+        write_partial(ids[filename], filename, params, pdf_results)
+        graded.add(filename)
+        page_count += len(pdf_results)
+        print(f"Graded {filename}: {len(pdf_results)} pages")
+    for filename in todo:
+        if filename not in graded:
+            # A PDF without pages still needs its (empty) partial result for the merge
+            write_partial(ids[filename], filename, params, [])
+    get_debug_writer().close()
+    print(f"Shard {index} of {count} completed. {len(todo)} PDFs, {page_count} pages processed.")
+    print(f"Partial results saved to: {shared_directory}")
+    if scheduler is not None:
+        scheduler.print_summary()
+    return page_count
+
+def merge():
+    """Combine the partial results of every input PDF into the grades and bands a single run would write."""
+    pdf_files = cropper.list_pdf_files(cropper.input_directory)
+    ids = content_ids(pdf_files)
+    partials = {filename: read_partial(ids[filename]) for filename in pdf_files}
+    missing = [filename for filename, partial in partials.items() if partial is None]
+    if missing:
+        raise SystemExit(f"No partial results yet for {len(missing)} of {len(pdf_files)} PDFs: {', '.join(missing)}")
+    if len({partial['params'] for partial in partials.values()}) > 1:
+        raise SystemExit("Partial results were produced with different parameters or form templates; "
+                         "run every node with the same config")
+
+    page_count = 0
+    with aligner.open_band_store() as band_store, \
+            open_results_writer(pipeline.output_directory, ocr.output_format, ocr.output_batch_size) as writer:
+        for i, filename in enumerate(pdf_files, start=1):
+            for page in partials[filename]['pages']:
+                name = f"aligned_{cropper.page_name(i, page['page'])}"
+                band_store.put(name, page['bands'])
+                writer.write_many({'page': name, **record} for record in page['records'])
+                page_count += 1
+        aligner.export_bands_json(band_store)
+    print(f"Grades saved to: {writer.path}")
+    print(f"Grade bands saved to: {band_store.path}")
+    print(f"Merge completed. {len(pdf_files)} PDFs, {page_count} pages.")
+    return page_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade a share of the input PDFs on this node, or merge the shares.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="grade this node's share of the input PDFs")
+    run_parser.add_argument('--index', type=int, default=shard_index, help="this node's shard, from 0")
+    run_parser.add_argument('--count', type=int, default=shard_count, help="number of nodes")
+    subparsers.add_parser('merge', help="combine every node's partial results")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_node(
+            args.index, args.count,
+            write_intermediate=config.getboolean('pipeline', 'write_intermediate', fallback=False),
+            workers=config.getint('pipeline', 'workers', fallback=1)
+        )
+    else:
+        merge()
+
+if __name__ == "__main__":
+    main()
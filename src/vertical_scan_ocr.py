@@ -4,6 +4,15 @@ import os
 import json
 import configparser
 
+from band_store import BandStore
+from debug_writer import get_debug_writer
+from intermediate import list_pages, read_page
+import metrics
+from page_image import pack_ink, to_bgr, to_gray, unpack_ink
+from parallel import map_ordered
+from resolution import pixels
+from results_writer import open_results_writer
+
 # Get the absolute path to the script's directory
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Get the parent directory (project root)
@@ -20,70 +29,128 @@ input_dir = config.get('ocr', 'input_dir')
 output_dir = config.get('ocr', 'output_dir')
 debug_dir = config.get('ocr', 'debug_dir')
 
-# Get OCR parameters from config
-cell_width = config.getint('ocr', 'cell_width')
-cell_height = config.getint('ocr', 'cell_height')
+# Get OCR parameters from config (cell sizes in pixels at the render resolution)
+cell_width = pixels(config.getint('ocr', 'cell_width'))
+cell_height = pixels(config.getint('ocr', 'cell_height'))
 ink_threshold = config.getint('ocr', 'ink_threshold')
 overlap_threshold = config.getfloat('ocr', 'overlap_threshold')
+# Ink is counted on the grayscale page, or on a bit-packed black-and-white copy of it
+ink_representation = config.get('ocr', 'ink_representation', fallback='gray')
+binarize_threshold = config.getint('ocr', 'binarize_threshold', fallback=160)
+confidence_margin = config.getfloat('debug', 'confidence_margin', fallback=10)
+output_format = config.get('ocr', 'output_format', fallback='csv')
+output_batch_size = config.getint('ocr', 'output_batch_size', fallback=500)
+grade_batch_size = config.getint('ocr', 'grade_batch_size', fallback=1)
 questions_file = config.get('questions', 'file')
 questions_path = os.path.join(project_root, "config", questions_file)
 questions = json.load(open(questions_path))
 number_of_questions = sum(len(section) for section in questions.values())
+# (section, question) pairs in questionnaire order
+question_list = [(section, question) for section, items in questions.items() for question in items]
 number_of_grades = config.getint('questions', 'number_of_grades')
 
-# Load the detected grade bands
+# Location of the band store written by the aligner
 json_dir = config.get('paths', 'json_dir')
-json_path = os.path.join(project_root, json_dir, 'detected_grade_bands.json')
-
-try:
-    with open(json_path, 'r') as f:
-        DETECTED_BANDS = json.load(f)
-except FileNotFoundError:
-    print(f"Error: Could not find {json_path}")
-    print("Make sure the aligner step has been run and produced the JSON file.")
-    exit(1)
-
-def detect_ink_cells(image_path):
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f"Error: Failed to load image: {image_path}")
-        return None, None
-
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = gray.shape
-    ink_cells = []
-
-    # Get the horizontal bands for this image
-    filename = os.path.basename(image_path)
-    image_bands = DETECTED_BANDS.get(filename, {})
-    horizontal_bands = image_bands.get('horizontal', [])
-
-    if not horizontal_bands:
-        print(f"Warning: No horizontal bands found for {filename}")
-        return None, None
-
-    for y in horizontal_bands:
-        for x in range(0, width - cell_width, cell_width // 2):
-            cell = gray[y:y+cell_height, x:x+cell_width]
-            avg_value = np.mean(cell)
-            if avg_value < ink_threshold:
-                ink_cells.append((x, y, cell_width, cell_height, 255 - avg_value))
-
-    nms_cells = non_max_suppression(ink_cells, overlap_threshold, max_detections=number_of_questions)
-    return nms_cells, image, width
+band_store_path = os.path.join(project_root, json_dir, config.get('paths', 'band_store', fallback='detected_grade_bands.sqlite'))
+
+def stage_params():
+    """Config values the OCR stage depends on (used in cache keys)."""
+    return {
+        'cell_width': cell_width,
+        'cell_height': cell_height,
+        'ink_threshold': ink_threshold,
+        'overlap_threshold': overlap_threshold,
+        'ink_representation': ink_representation,
+        'binarize_threshold': binarize_threshold,
+        'number_of_questions': number_of_questions
+    }
+
+def ink_page(gray):
+    """The form of a grayscale page ink is counted on (see ink_representation)."""
+    return pack_ink(gray, binarize_threshold) if ink_representation == 'packed' else gray
+
+def packed_width(width):
+    """The packed_width to pass along with ink_page output for a page of the given width."""
+    return width if ink_representation == 'packed' else None
+
+def band_column_sums(gray, horizontal_bands, cell_height, packed_width=None):
+    """Sum the cell_height rows below each band per column, clipped at the page bottom.
+
+    Returns an int64 array of shape (bands, width + 1) holding, for every band,
+    the running sum over columns with a leading zero (a summed-area table
+    restricted to the band's rows). gray may also be a stack of pages of shape
+    (pages, height, width), giving a (pages, bands, width + 1) array. When
+    packed_width is given, gray is the pack_ink form of pages that wide, read
+    as ink = 0 and paper = 255; only the band rows are ever unpacked.
+    """
+    height = gray.shape[-2]
+    width = packed_width or gray.shape[-1]
+    rows = np.asarray(horizontal_bands, dtype=np.int64)[:, None] + np.arange(cell_height)
+    inside = rows < height
+    strips = gray[..., np.minimum(rows, height - 1), :]
+    if packed_width is not None:
+        strips = (1 - unpack_ink(strips, packed_width)) * 255
+    strips = strips * inside[:, :, None]
+    table = np.zeros(gray.shape[:-2] + (len(rows), width + 1), dtype=np.int64)
+    np.cumsum(strips.sum(axis=-2, dtype=np.int64), axis=-1, out=table[..., 1:])
+    return table
+
+def cell_means(gray, horizontal_bands, packed_width=None):
+    """Mean of every cell window on every band, for one page or a stack of pages.
+
+    Windows start on each band at half-cell x-offsets; windows running past
+    the bottom of the page are clipped as slicing would clip them. Returns the
+    window x-offsets, the band rows and the means, of shape (bands, windows)
+    per page. packed_width is as for band_column_sums.
+    """
+    height = gray.shape[-2]
+    width = packed_width or gray.shape[-1]
+    ys = np.asarray(horizontal_bands, dtype=np.int64)
+    xs = np.arange(0, width - cell_width, cell_width // 2)
+    table = band_column_sums(gray, ys, cell_height, packed_width)
+
+    sums = table[..., xs + cell_width] - table[..., xs]
+    means = sums / ((np.minimum(ys + cell_height, height) - ys)[:, None] * cell_width)
+    return xs, ys, means
+
+def scan_ink_cells(gray, horizontal_bands, packed_width=None):
+    """Compute the mean of every cell window on every band in one pass.
+
+    Returns an (N, 5) float array of (x, y, w, h, score) ink candidates in
+    band-then-x order.
+    """
+    xs, ys, means = cell_means(gray, horizontal_bands, packed_width)
+
+    band_index, x_index = np.nonzero(means < ink_threshold)
+    candidates = np.empty((len(band_index), 5), dtype=np.float64)
+    candidates[:, 0] = xs[x_index]
+    candidates[:, 1] = ys[band_index]
+    candidates[:, 2] = cell_width
+    candidates[:, 3] = cell_height
+    candidates[:, 4] = 255 - means[band_index, x_index]
+    return candidates
+
+def detect_ink_cells(image, horizontal_bands):
+    with metrics.span('ink_scan'):
+        gray = to_gray(image)
+        ink_cells = scan_ink_cells(ink_page(gray), horizontal_bands, packed_width(gray.shape[1]))
+    with metrics.span('nms'):
+        nms_cells = non_max_suppression(ink_cells, overlap_threshold, max_detections=number_of_questions)
+    return nms_cells
 
 def non_max_suppression(cells, overlap_threshold=0.3, max_detections=None):
     if len(cells) == 0:
         return []
 
-    boxes = np.array(cells)
+    boxes = np.asarray(cells, dtype=np.float64)
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
     x2 = boxes[:, 0] + boxes[:, 2]
     y2 = boxes[:, 1] + boxes[:, 3]
     scores = boxes[:, 4]
 
-    order = scores.argsort()[::-1]
+    # Highest score first; equal scores keep their input order, as grade_batch's argmax does
+    order = np.argsort(-scores, kind='stable')
     keep = []
 
     while order.size > 0:
@@ -108,7 +175,7 @@ def non_max_suppression(cells, overlap_threshold=0.3, max_detections=None):
 
     return boxes[keep].tolist()
 
-def filter_horizontal_cells(ink_cells, vertical_threshold=5):
+def filter_horizontal_cells(ink_cells, vertical_threshold=pixels(5)):
     sorted_cells = sorted(ink_cells, key=lambda cell: (cell[1], -cell[0]))
     filtered_cells = []
     for i, cell in enumerate(sorted_cells):
@@ -117,51 +184,232 @@ def filter_horizontal_cells(ink_cells, vertical_threshold=5):
     return filtered_cells
 
 def calculate_grades(ink_cells, image_width, vertical_bands):
-    grades = []
-    for cell in ink_cells:
-        x, y, w, h, _ = cell
-        centroid_x = x + w / 2
-        centroid_y = y + h / 2
-        
-        # Use detected bands to determine the grade
-        for i in range(len(vertical_bands) - 1):
-            low = vertical_bands[i]
-            high = vertical_bands[i+1]
-            if low <= centroid_x < high:
-                grade = i + 1
-                grade_percentage = ((centroid_x - low) / (high - low)) * 100
-                break
-        else:
-            grade = None
-            grade_percentage = None
-
-        grades.append((centroid_y, grade_percentage, grade))
+    cells = np.asarray(ink_cells, dtype=np.float64).reshape(-1, 5)
+    centroid_x = cells[:, 0] + cells[:, 2] / 2
+    centroid_y = cells[:, 1] + cells[:, 3] / 2
+
+    # Use detected bands to determine the grade: band i holds low <= x < high
+    bands = np.asarray(vertical_bands)
+    if len(bands) < 2:
+        grades = [(y, None, None) for y in centroid_y.tolist()]
+    else:
+        index = np.clip(np.searchsorted(bands, centroid_x, side='right') - 1, 0, len(bands) - 2)
+        low = bands[index]
+        high = bands[index + 1]
+        valid = (low <= centroid_x) & (centroid_x < high)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentage = ((centroid_x - low) / (high - low)) * 100
+
+        grades = [
+            (y, p, i + 1) if ok else (y, None, None)
+            for y, p, i, ok in zip(centroid_y.tolist(), percentage.tolist(), index.tolist(), valid.tolist())
+        ]
 
     # Sort grades by y-coordinate (top to bottom)
     grades.sort(key=lambda x: x[0])
 
     return grades
 
-def draw_ink_cells_and_bands(image, ink_cells, grades, vertical_bands):
-    height, width, _ = image.shape
+def window_overlaps(xs, ys, chosen):
+    """Which cell windows each chosen window suppresses, measured as non_max_suppression does.
+
+    Windows are numbered band-major, as in the flattened (bands, windows)
+    means. All windows are the same size, so the intersections factor into
+    an x and a y part. Returns a (chosen, windows) boolean array.
+    """
+    inter_x = np.maximum(0.0, cell_width - np.abs(xs[chosen % len(xs), None] - xs[None, :]) + 1)
+    inter_y = np.maximum(0.0, cell_height - np.abs(ys[chosen // len(xs), None] - ys[None, :]) + 1)
+    inter = (inter_y[:, :, None] * inter_x[:, None, :]).reshape(len(chosen), -1)
+    overlaps = inter / (2 * cell_width * cell_height - inter) > overlap_threshold
+    overlaps[np.arange(len(chosen)), chosen] = True
+    return overlaps
+
+def grade_batch(grays, image_bands, packed_width=None, vertical_threshold=pixels(5)):
+    """Grade a stack of aligned pages sharing the same bands, all at once.
+
+    Does what detect_ink_cells, filter_horizontal_cells and calculate_grades
+    do page by page, but with array operations over the whole stack: greedy
+    suppression runs one detection per step for every page together, and
+    cells are matched to questions per row. grays has shape (pages, height,
+    width), or holds ink_page output with packed_width set. Returns (cells, percentages, grades) matrices with one row per
+    page and one column per question, in top-to-bottom order: cells is
+    (pages, questions, 5) holding (x, y, w, h, score), NaN where a page has
+    fewer marks; percentages is NaN and grades is 0 where there is no grade.
+    """
+    pages = len(grays)
+    cells = np.full((pages, number_of_questions, 5), np.nan)
+    percentages = np.full((pages, number_of_questions), np.nan)
+    grades = np.zeros((pages, number_of_questions), dtype=np.int64)
+    horizontal_bands = image_bands.get('horizontal', [])
+    vertical_bands = np.asarray(image_bands.get('vertical', []))
+    if not horizontal_bands or len(vertical_bands) == 0:
+        return cells, percentages, grades
+
+    with metrics.span('ink_scan'):
+        xs, ys, means = cell_means(grays, horizontal_bands, packed_width)
+        scores = np.where(means < ink_threshold, 255 - means, -np.inf).reshape(pages, -1)
+
+    with metrics.span('nms'):
+        rows = np.arange(pages)
+        keep = np.full((pages, number_of_questions), -1)
+        keep_scores = np.full((pages, number_of_questions), np.nan)
+        for k in range(number_of_questions):
+            best = scores.argmax(axis=1)
+            found = scores[rows, best] > -np.inf
+            if not found.any():
+                break
+            keep[found, k] = best[found]
+            keep_scores[found, k] = scores[found, best[found]]
+            scores[found] = np.where(window_overlaps(xs, ys, best[found]), -np.inf, scores[found])
+
+    with metrics.span('grading'):
+        found = keep >= 0
+        x = np.where(found, xs[keep % len(xs)], np.nan)
+        y = np.where(found, ys[keep // len(xs)], np.nan)
+
+        # Top to bottom, rightmost first on a row; a cell within vertical_threshold
+        # of the one before it on the page is dropped (missing cells sort last)
+        order = np.lexsort((-x, y), axis=-1)
+        x = np.take_along_axis(x, order, axis=1)
+        y = np.take_along_axis(y, order, axis=1)
+        score = np.take_along_axis(keep_scores, order, axis=1)
+        kept = ~np.isnan(y)
+        kept[:, 1:] &= ~(np.abs(np.diff(y, axis=1)) <= vertical_threshold)
+
+        # Compact the kept cells to the left, in order
+        position = np.cumsum(kept, axis=1) - 1
+        page_index, cell_index = np.nonzero(kept)
+        column = position[page_index, cell_index]
+        cells[page_index, column] = np.stack([
+            x[page_index, cell_index], y[page_index, cell_index],
+            np.full(len(page_index), cell_width), np.full(len(page_index), cell_height),
+            score[page_index, cell_index]
+        ], axis=1)
+
+        centroid_x = cells[:, :, 0] + cell_width / 2
+        if len(vertical_bands) >= 2:
+            index = np.clip(np.searchsorted(vertical_bands, centroid_x, side='right') - 1, 0, len(vertical_bands) - 2)
+            low = vertical_bands[index]
+            high = vertical_bands[index + 1]
+            valid = (low <= centroid_x) & (centroid_x < high)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                percentages = np.where(valid, (centroid_x - low) / (high - low) * 100, np.nan)
+            grades = np.where(valid, index + 1, 0)
+    return cells, percentages, grades
+
+def page_grades(cells, percentages, grades):
+    """One page's row of the grade_batch matrices as the (ink_cells, grades) grade_image returns."""
+    present = ~np.isnan(cells[:, 1])
+    ink_cells = cells[present].tolist()
+    grade_tuples = [
+        (y + cell_height / 2, None, None) if grade == 0 else (y + cell_height / 2, percentage, grade)
+        for (_, y, _, _, _), percentage, grade in zip(ink_cells, percentages[present].tolist(), grades[present].tolist())
+    ]
+    return ink_cells, grade_tuples
+
+def draw_ink_cells_and_bands(image, ink_cells, grades, vertical_bands, scale=1.0):
+    """The page with its ink cells, grades and bands drawn on it, at the given scale of the page."""
+    image = to_bgr(image, scale)
+    height, width = image.shape[:2]
 
     # Draw grade bands
     for i, x in enumerate(vertical_bands):
+        x = round(x * scale)
         cv2.line(image, (x, 0), (x, height), (200, 200, 200), 1)
         if i < len(vertical_bands) - 1:
             cv2.putText(image, str(i+1), (x + 5, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (200, 200, 200), 2)
 
     # Draw cells and grades
     for cell, (_, percentage, grade) in zip(ink_cells, grades):
-        x, y, w, h, _ = map(int, cell)
+        x, y, w, h = (int(v * scale) for v in cell[:4])
         cv2.rectangle(image, (x, y), (x+w, y+h), (0, 255, 0), 2)
         if percentage is not None and grade is not None:
             cv2.putText(image, f"{percentage:.1f}% (Grade: {grade})", (x, y-5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
 
     return image
 
+def grade_image(image, image_bands, name):
+    """Grade an aligned page given its band entry; returns (ink_cells, grades) or (None, None)."""
+    horizontal_bands = image_bands.get('horizontal', [])
+    if not horizontal_bands:
+        print(f"Warning: No horizontal bands found for {name}")
+        return None, None
+
+    vertical_bands = image_bands.get('vertical', [])
+    if not vertical_bands:
+        print(f"Warning: No vertical bands found for {name}")
+        return None, None
+
+    ink_cells = detect_ink_cells(image, horizontal_bands)
+    with metrics.span('grading'):
+        ink_cells = filter_horizontal_cells(ink_cells)
+        grades = calculate_grades(ink_cells, image.shape[1], vertical_bands)
+    return ink_cells, grades
+
+def is_low_confidence(grades):
+    """True when a page is missing answers or has a mark within confidence_margin % of a band edge."""
+    if len(grades) != number_of_questions:
+        return True
+    for _, percentage, grade in grades:
+        if grade is None or not confidence_margin <= percentage <= 100 - confidence_margin:
+            return True
+    return False
+
+def grade_records(name, ink_cells, grades):
+    """One record per detected answer, matched to questions.json in top-to-bottom order."""
+    records = []
+    for i, (cell, (_, percentage, grade)) in enumerate(zip(ink_cells, grades)):
+        section, question = question_list[i] if i < len(question_list) else (None, None)
+        records.append({
+            'page': name,
+            'question_number': i + 1,
+            'section': section,
+            'question': question,
+            'grade': grade,
+            'grade_percentage': percentage,
+            'cell_score': float(cell[4])
+        })
+    return records
+
+def print_grades(name, grades):
+    print(f"Grades for {name}:")
+    for i, (_, percentage, grade) in enumerate(grades, 1):
+        if percentage is not None and grade is not None:
+            print(f"  Question {i}: {percentage:.1f}% (Grade: {grade})")
+        else:
+            print(f"  Question {i}: Unable to determine grade")
+
+def grade_file(task):
+    """Grade one aligned PNG and queue its debug image if the debug policy wants it.
+
+    Returns (ink_cells, grades) or None.
+    """
+    image_path, image_bands, debug_image_path, page_index = task
+    original_image = read_page(image_path)
+    if original_image is None:
+        print(f"Error: Failed to load image: {image_path}")
+        return None
+
+    ink_cells, grades = grade_image(original_image, image_bands, os.path.basename(image_path))
+    if ink_cells is None:
+        return None
+
+    debug_writer = get_debug_writer()
+    if debug_writer.wants(page_index, is_low_confidence(grades)):
+        # Draw ink cells, grades, and bands on the image
+        debug_image = draw_ink_cells_and_bands(original_image, ink_cells, grades, image_bands['vertical'], debug_writer.scale)
+        debug_writer.write(debug_image_path, debug_image, scaled=True)
+        print(f"Debug image saved: {debug_writer.path(debug_image_path)}")
+    return ink_cells, grades
+
 # Main execution
 if __name__ == "__main__":
+    if not os.path.exists(band_store_path):
+        print(f"Error: Could not find {band_store_path}")
+        print("Make sure the aligner step has been run and produced the band store.")
+        exit(1)
+    band_store = BandStore(band_store_path)
+
     # Define directories using config
     input_directory = os.path.join(project_root, input_dir)
     debug_directory = os.path.join(project_root, debug_dir)
@@ -172,41 +420,28 @@ if __name__ == "__main__":
     # Ensure debug directory exists
     os.makedirs(debug_directory, exist_ok=True)
 
-    # Get all PNG files in the input directory
-    png_files = [f for f in os.listdir(input_directory) if f.endswith('.png')]
-    png_files.sort()
+    # Get all pages in the input directory
+    png_files = list_pages(input_directory)
 
     if png_files:
-        for filename in png_files:
-            image_path = os.path.join(input_directory, filename)
-            ink_cells, original_image, image_width = detect_ink_cells(image_path)
-
-            if ink_cells is not None and original_image is not None:
-                # Get the detected bands for this specific image
-                image_bands = DETECTED_BANDS.get(filename, {})
-                vertical_bands = image_bands.get('vertical', [])
-                if not vertical_bands:
-                    print(f"Warning: No vertical bands found for {filename}")
-                    continue
-
-                ink_cells = filter_horizontal_cells(ink_cells)
-                grades = calculate_grades(ink_cells, image_width, vertical_bands)
-
-                print(f"Grades for {filename}:")
-                for i, (_, percentage, grade) in enumerate(grades, 1):
-                    if percentage is not None and grade is not None:
-                        print(f"  Question {i}: {percentage:.1f}% (Grade: {grade})")
-                    else:
-                        print(f"  Question {i}: Unable to determine grade")
-
-                # Draw ink cells, grades, and bands on the image
-                debug_image = draw_ink_cells_and_bands(original_image.copy(), ink_cells, grades, vertical_bands)
-
-                # Save the debug image
-                debug_image_path = os.path.join(debug_directory, f"debug_{filename}")
-                cv2.imwrite(debug_image_path, debug_image)
-                print(f"Debug image saved: {debug_image_path}")
+        workers = config.getint('pipeline', 'workers', fallback=1)
+        # Bands are looked up page by page as tasks are handed out
+        tasks = (
+            (os.path.join(input_directory, filename),
+             band_store.get(filename) or {},
+             os.path.join(debug_directory, f"debug_{filename}"),
+             i)
+            for i, filename in enumerate(png_files)
+        )
+        with open_results_writer(os.path.join(project_root, output_dir), output_format, output_batch_size) as writer:
+            for filename, result in zip(png_files, map_ordered(grade_file, tasks, workers)):
+                if result is not None:
+                    ink_cells, grades = result
+                    writer.write_many(grade_records(filename, ink_cells, grades))
+                    print_grades(filename, grades)
+        get_debug_writer().close()
+        print(f"Grades saved to: {writer.path}")
 
         print(f"Grade extraction completed. {len(png_files)} images processed.")
     else:
-        print("No PNG files found in the input directory.")
\ No newline at end of file
+        print("No PNG files found in the input directory.")